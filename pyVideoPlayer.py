@@ -18,13 +18,141 @@
 import os
 import sys
 import time
+import json
+import math
+import array
+import bisect
 import ctypes
+import ctypes.util
+import mmap
+import queue
+import struct
+import hashlib
+import socket
+import sqlite3
+import argparse
+import urllib.parse
+import xml.etree.ElementTree
+import tempfile
+import platform
+import threading
+import http.server
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    # only the frame tap needs it
+    import numpy
+except ImportError:
+    numpy = None
+
+sort_keys = ("name", "mtime", "size")
+
+
+def parse_args(argv = None):
+    parser = argparse.ArgumentParser(description="A simple Python Video Player")
+    parser.add_argument("files", nargs="*", metavar="file",
+                        help="video to play, its directory becomes the playlist; several files are played as given")
+    parser.add_argument("--preload", type=int, default=1, metavar="N",
+                        help="keep N neighbouring videos pre-rolled for instant switching (0 disables)")
+    parser.add_argument("--ext", default=".mp4,.mkv",
+                        help="comma separated extensions to include in the playlist")
+    parser.add_argument("--sort", choices=sort_keys, default="name",
+                        help="playlist order")
+    parser.add_argument("--reverse", action=argparse.BooleanOptionalAction, default=True,
+                        help="reverse the playlist order")
+    parser.add_argument("--probe-workers", type=int, default=2, metavar="N",
+                        help="threads probing playlist metadata in the background (0 disables)")
+    parser.add_argument("--retry-unplayable", action="store_true",
+                        help="forget which files were found unplayable and check them again")
+    parser.add_argument("--thumbnails", action=argparse.BooleanOptionalAction, default=True,
+                        help="show a preview frame when hovering over the progress bar")
+    parser.add_argument("--chapters", action=argparse.BooleanOptionalAction, default=True,
+                        help="mark scene cuts on the progress bar, Page Up/Down jump between them (needs numpy)")
+    parser.add_argument("--waveform", action=argparse.BooleanOptionalAction, default=True,
+                        help="draw the audio peak/RMS overview behind the progress bar (needs numpy)")
+    parser.add_argument("--keyframes", action=argparse.BooleanOptionalAction, default=True,
+                        help="index the keyframes of each file so seeks land exactly where asked")
+    parser.add_argument("--frame-cache", type=int, default=64, metavar="MB",
+                        help="memory for decoded frames, served by frame steps and small scrubs while paused (0 disables)")
+    parser.add_argument("--video-sink", metavar="ELEMENT",
+                        help="video sink to use instead of the probed fastest one")
+    parser.add_argument("--decoder-threads", type=int, metavar="N",
+                        help="decoder max-threads instead of the probed fastest (0 = automatic)")
+    parser.add_argument("--probe", action=argparse.BooleanOptionalAction, default=True,
+                        help="time the available sinks and decoder threads once per machine")
+    parser.add_argument("--reprobe", action="store_true", help="run the sink probe again")
+    parser.add_argument("--downscale", action=argparse.BooleanOptionalAction, default=True,
+                        help="scale decoded frames down to the window size before they reach the sink")
+    parser.add_argument("--ring-buffer", type=int, default=0, metavar="MB",
+                        help="keep at most MB of an http(s) download on disk (0 keeps the whole file)")
+    parser.add_argument("--buffer-size", type=int, metavar="KB",
+                        help="http(s) buffer that has to fill before playback (re)starts")
+    parser.add_argument("--buffer-duration", type=float, metavar="SECONDS",
+                        help="http(s) buffer length in time instead of the bitrate based estimate")
+    parser.add_argument("--detect-black", action="store_true",
+                        help="print where black frames start and end (needs numpy)")
+    parser.add_argument("--mosaic", type=int, metavar="N",
+                        help="play N videos of the playlist side by side (up to 16), starting at the given file")
+    parser.add_argument("--stats-log", metavar="PATH",
+                        help="append a JSON line of playback counters to PATH every --stats-interval")
+    parser.add_argument("--stats-port", type=int, metavar="PORT",
+                        help="serve playback counters as JSON on http://127.0.0.1:PORT/metrics")
+    parser.add_argument("--stats-interval", type=float, default=5, metavar="SECONDS")
+    parser.add_argument("--new-instance", action="store_true",
+                        help="don't hand the files over to an already running player")
+    return parser.parse_args(argv)
+
+
+def instance_socket_path():
+    runtime = os.environ.get("XDG_RUNTIME_DIR") or tempfile.gettempdir()
+    return os.path.join(runtime, "pyVideoPlayer-%d.sock" % os.getuid())
+
+
+def hand_off(files):
+    # Give files to an already running player. This runs before gi is imported, so a
+    # second launch exits within milliseconds; True when a player took the files.
+    # Exits with its message when the player refused them.
+    if not hasattr(socket, "AF_UNIX"):
+        return False
+    message = {"files": [f if "://" in f else os.path.abspath(f) for f in files]}
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(2)
+            sock.connect(instance_socket_path())
+            sock.sendall(json.dumps(message).encode() + b"\n")
+            reply = sock.recv(4096)
+    except OSError:
+        return False
+    if reply.startswith(b"error"):
+        # the running player refused them, starting a second one wouldn't do better
+        sys.exit(reply.decode(errors = "replace").strip())
+    return reply.startswith(b"ok")
+
+
+def instance_options(args):
+    # options given that only a new player can honour, the running one keeps its own
+    defaults = vars(parse_args([]))
+    return [name for name, value in vars(args).items()
+            if name not in ("files", "new_instance") and value != defaults[name]]
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if instance_options(args):
+        # e.g. --mosaic or --stats-port: start a player of our own, which leaves the
+        # running one (and its socket) alone
+        args.new_instance = True
+    if args.files and not args.new_instance and hand_off(args.files):
+        sys.exit(0)
 
 import gi
 gi.require_version("Gtk", "3.0")
 gi.require_version("Gst", "1.0")
 gi.require_version("GstVideo", "1.0")
-from gi.repository import Gst, Gtk, Gdk, GLib, GstVideo, GObject
+gi.require_version("GstPbutils", "1.0")
+gi.require_version("GdkPixbuf", "2.0")
+from gi.repository import Gst, Gtk, Gdk, GLib, GstVideo, GstPbutils, GdkPixbuf, GObject
 
 Gst.init(None)
 
@@ -84,31 +212,2175 @@ else:
         return widget.get_window().get_xid()
 
 
+def cache_dir(*parts):
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    path = os.path.join(base, "pyVideoPlayer", *parts)
+    os.makedirs(path, exist_ok = True)
+    return path
+
+
+def file_identity(uri):
+    # (path, size, mtime) of a file:// uri, the key for everything cached per file
+    path = GLib.filename_from_uri(uri)[0]
+    stat = os.stat(path)
+    return (path, stat.st_size, stat.st_mtime_ns)
+
+
+def cache_file(kind, uri, suffix):
+    digest = hashlib.sha1(repr(file_identity(uri)).encode()).hexdigest()
+    return os.path.join(cache_dir(kind), digest + suffix)
+
+
+def format_time(ns):
+    seconds = ns // Gst.SECOND
+    return "%d:%02d:%02d" % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+def has_extension(name, ext):
+    # the playlist's file filter: ext is a tuple of extensions, matched case-insensitively
+    return name.lower().endswith(tuple(e.lower() for e in ext))
+
+
+def is_stream(uri):
+    # http(s) uris get progressive download buffering, everything else plays as is
+    return uri is not None and Gst.uri_is_valid(uri) and Gst.uri_get_protocol(uri) in ("http", "https")
+
+
+def is_file_error(error):
+    # decoder, demuxer and format errors are the file's fault, and so is a file that
+    # can't be opened (see is_missing_error); other resource, sink and core errors (a
+    # busy audio device, a lost display) say nothing about the file
+    return error.domain == GLib.quark_to_string(Gst.stream_error_quark()) or is_missing_error(error)
+
+
+def is_missing_error(error):
+    # the entry isn't there or can't be read: deleted, no permission, a 404. That may
+    # change, so unlike a broken stream it is only remembered for this session
+    return (error.domain == GLib.quark_to_string(Gst.resource_error_quark()) and
+            error.code in (Gst.ResourceError.NOT_FOUND, Gst.ResourceError.OPEN_READ))
+
+
+def set_decoder_threads(element, threads):
+    # libav decoders (and a few others) take a thread count, 0 meaning automatic
+    if threads is not None and element.find_property("max-threads") is not None:
+        element.set_property("max-threads", threads)
+
+
+class Inotify:
+    # Minimal ctypes binding, enough to follow one directory from the GLib main loop.
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_DELETE = 0x00000200
+    IN_NONBLOCK = 0o4000
+    _header = struct.Struct("iIII")
+
+    def __init__(self, path, mask, callback):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno = True)
+        self.fd = libc.inotify_init1(self.IN_NONBLOCK)
+        if self.fd < 0 or libc.inotify_add_watch(self.fd, os.fsencode(path), mask) < 0:
+            raise OSError(ctypes.get_errno(), "inotify failed for " + path)
+        self.callback = callback
+        self._source_id = GLib.io_add_watch(self.fd, GLib.PRIORITY_DEFAULT_IDLE,
+                                            GLib.IOCondition.IN, self._on_readable)
+
+    def _on_readable(self, fd, condition):
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return True
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = self._header.unpack_from(data, offset)
+            offset += self._header.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+            offset += length
+            self.callback(mask, name)
+        return True
+
+    def close(self):
+        GLib.source_remove(self._source_id)
+        os.close(self.fd)
+
+
+class Playlist:
+    # The videos of one directory, in sort order. The launched file is the only entry
+    # until load()/load_async() has listed the directory with os.scandir, so playback
+    # can start right away. Listings are cached on disk keyed by the directory mtime
+    # and kept current with inotify. Entries are held as a sorted list of sort keys,
+    # so locating a file (and its neighbours) is a bisect.
+
+    sort_keys = sort_keys
+
+    def __init__(self, path, ext = (".mp4", ".mkv"), sort = "name", reverse = True):
+        if sort not in self.sort_keys:
+            raise GenericException("Unknown sort key " + sort)
+        path = os.path.abspath(path)
+        self.directory = os.path.dirname(path)
+        self.current = os.path.basename(path)
+        self.ext = tuple(e.lower() for e in ext)
+        self.sort = sort
+        self.reverse = reverse
+        self.loaded = False
+        # called from the main loop whenever entries were added or removed
+        self.on_change = None
+        self._key_of = {}
+        self._keys = []
+        self._inotify = None
+        self._save_id = None
+        self._add(self.current, os.stat(path))
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self._keys)
+        if self.reverse:
+            index = len(self._keys) - 1 - index
+        return Gst.filename_to_uri(os.path.join(self.directory, self._keys[index][-1]))
+
+    def index_of(self, item):
+        # item is a uri, path or bare file name; None when it isn't listed
+        if "://" in item:
+            item = GLib.filename_from_uri(item)[0]
+        key = self._key_of.get(os.path.basename(item))
+        if key is None:
+            return None
+        index = bisect.bisect_left(self._keys, key)
+        return len(self._keys) - 1 - index if self.reverse else index
+
+    def _make_key(self, name, stat):
+        if self.sort == "mtime":
+            return (stat.st_mtime_ns, name)
+        if self.sort == "size":
+            return (stat.st_size, name)
+        return (name,)
+
+    def _add(self, name, stat = None):
+        if name in self._key_of:
+            self._remove(name)
+        key = self._make_key(name, stat)
+        self._key_of[name] = key
+        bisect.insort(self._keys, key)
+
+    def _remove(self, name):
+        key = self._key_of.pop(name, None)
+        if key is not None:
+            del self._keys[bisect.bisect_left(self._keys, key)]
+
+    def _wanted(self, name):
+        # the launched file is listed whatever its extension, but only in memory:
+        # _loaded() adds it, the cached listing holds extension matches only
+        return has_extension(name, self.ext)
+
+    def _cache_path(self):
+        digest = hashlib.sha1(os.fsencode(self.directory)).hexdigest()
+        return os.path.join(cache_dir("playlists"), digest + ".json")
+
+    def _scan(self):
+        mtime = os.stat(self.directory).st_mtime_ns
+        try:
+            with open(self._cache_path()) as f:
+                cached = json.load(f)
+            if (cached["mtime"] == mtime and cached["sort"] == self.sort
+                    and cached["ext"] == list(self.ext)):
+                return [tuple(key) for key in cached["keys"]]
+        except (OSError, ValueError, KeyError):
+            pass
+        keys = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if self._wanted(entry.name) and entry.is_file():
+                    # name sorting needs no stat call, which matters on NFS
+                    stat = entry.stat() if self.sort != "name" else None
+                    keys.append(self._make_key(entry.name, stat))
+        keys.sort()
+        self._save(keys, mtime)
+        return keys
+
+    def _save(self, keys, mtime):
+        keys = [key for key in keys if self._wanted(key[-1])]
+        path = self._cache_path()
+        try:
+            with open(path + ".tmp", "w") as f:
+                json.dump({"directory": self.directory, "mtime": mtime, "sort": self.sort,
+                           "ext": list(self.ext), "keys": keys}, f)
+            os.replace(path + ".tmp", path)
+        except OSError as e:
+            print("Couldn't save playlist index: " + str(e))
+
+    def load(self):
+        self._loaded(self._scan())
+
+    def load_async(self):
+        def scan():
+            keys = self._scan()
+            GLib.idle_add(self._loaded, keys)
+        threading.Thread(target = scan, name = "playlist-scan", daemon = True).start()
+
+    def _loaded(self, keys):
+        current = self._key_of.get(self.current)
+        self._keys = keys
+        self._key_of = dict((key[-1], key) for key in keys)
+        if current is not None and self.current not in self._key_of:
+            self._key_of[self.current] = current
+            bisect.insort(self._keys, current)
+        self.loaded = True
+        self._watch()
+        self._changed()
+        return False
+
+    def _watch(self):
+        if not sys.platform.startswith("linux") or self._inotify is not None:
+            return
+        mask = (Inotify.IN_CLOSE_WRITE | Inotify.IN_MOVED_TO |
+                Inotify.IN_DELETE | Inotify.IN_MOVED_FROM)
+        try:
+            self._inotify = Inotify(self.directory, mask, self._on_inotify)
+        except OSError as e:
+            print("Not watching playlist directory: " + str(e))
+
+    def _on_inotify(self, mask, name):
+        if not self._wanted(name) and name != self.current:
+            return
+        if mask & (Inotify.IN_DELETE | Inotify.IN_MOVED_FROM):
+            self._remove(name)
+        else:
+            try:
+                self._add(name, os.stat(os.path.join(self.directory, name)))
+            except OSError:
+                return
+        self._changed()
+        # batch index rewrites, file copies produce bursts of events
+        if self._save_id is None:
+            self._save_id = GLib.timeout_add_seconds(2, self._save_later)
+
+    def _save_later(self):
+        self._save_id = None
+        self._save(self._keys, os.stat(self.directory).st_mtime_ns)
+        return False
+
+    def _changed(self):
+        if self.on_change is not None:
+            self.on_change()
+
+    def close(self):
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
+
+
+class PlaylistFile:
+    # The entries of an M3U/M3U8 or XSPF playlist, local paths and URIs mixed, with the
+    # same interface as Playlist. The file is parsed by a generator: the first entry
+    # is read right away, the rest in idle chunks from the main loop, so playback starts
+    # before a huge playlist is read through. Entries are packed one after another in a
+    # bytearray with an array('Q') of where each starts, and only turned into a uri
+    # when asked for, so a lookup by index is O(1) and there is no string per entry.
+
+    extensions = (".m3u", ".m3u8", ".xspf")
+    chunk = 5000   # entries parsed per idle callback
+    recent = 64    # uris the player opened, remembered for index_of()
+    xspf = "{http://xspf.org/ns/0/}"
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.directory = os.path.dirname(self.path)
+        self.loaded = False
+        # called from the main loop once the whole playlist has been read
+        self.on_change = None
+        self._data = bytearray()
+        self._starts = array.array("Q")
+        self._entries = self._parse()
+        self._idle_id = None
+        self._recent = collections.OrderedDict()   # uri -> index, see remember()
+        if not self._read(1):
+            raise GenericException("No entries in playlist " + self.path)
+
+    def __len__(self):
+        return len(self._starts)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self._starts)
+        start = self._starts[index]
+        end = self._starts[index + 1] if index + 1 < len(self._starts) else len(self._data)
+        return self._resolve(bytes(self._data[start:end]).decode("utf-8", "surrogateescape"))
+
+    def remember(self, uri, index):
+        # the player calls this for the files it opens or pre-rolls, the ones it looks
+        # up again; plain reads (e.g. the metadata walk) would push them out
+        self._recent[uri] = index
+        self._recent.move_to_end(uri)
+        if len(self._recent) > self.recent:
+            self._recent.popitem(last = False)
+
+    def _resolve(self, entry):
+        if "://" in entry:
+            return entry
+        # paths are relative to the playlist
+        return Gst.filename_to_uri(os.path.normpath(os.path.join(self.directory, entry)))
+
+    def index_of(self, item):
+        # remembered uris are found right away; anything else is searched for in the
+        # packed entries as written in the file: the uri, the absolute path or the path
+        # relative to the playlist. None when it isn't listed (in one of those forms).
+        if "://" not in item:
+            item = Gst.filename_to_uri(os.path.abspath(item))
+        if item in self._recent:
+            return self._recent[item]
+        targets = [item]
+        if item.startswith("file://"):
+            path = GLib.filename_from_uri(item)[0]
+            targets.append(path)
+            try:
+                targets.append(os.path.relpath(path, self.directory))
+            except ValueError:
+                pass   # another drive on Windows
+        for target in targets:
+            index = self._find(target.encode("utf-8", "surrogateescape"))
+            if index is not None:
+                return index
+        return None
+
+    def _find(self, entry):
+        # index of the packed entry equal to entry, found with bytearray.find
+        start = self._data.find(entry)
+        while start >= 0:
+            i = bisect.bisect_left(self._starts, start)
+            if i < len(self._starts) and self._starts[i] == start:
+                end = self._starts[i + 1] if i + 1 < len(self._starts) else len(self._data)
+                if end == start + len(entry):
+                    return i
+            start = self._data.find(entry, start + 1)
+        return None
+
+    def _parse(self):
+        # yields the entries as raw strings in file order
+        if self.path.lower().endswith(".xspf"):
+            # the first location of each playlist/trackList/track; the playlist's own
+            # location and a track's alternative locations aren't entries
+            base = Gst.filename_to_uri(self.directory) + "/"
+            path = [self.xspf + "playlist", self.xspf + "trackList", self.xspf + "track"]
+            tags = []
+            track_list = found = None
+            for event, element in xml.etree.ElementTree.iterparse(self.path, ("start", "end")):
+                if event == "start":
+                    tags.append(element.tag)
+                    if tags == path[:2]:
+                        track_list = element
+                    elif tags == path:
+                        found = False
+                    continue
+                if tags == path + [self.xspf + "location"] and not found and element.text:
+                    found = True
+                    yield urllib.parse.urljoin(base, element.text.strip())
+                elif tags == path and track_list is not None:
+                    # finished tracks are dropped so the tree doesn't grow with the file
+                    track_list.clear()
+                tags.pop()
+            return
+        # .m3u8 is UTF-8; a plain .m3u is too nowadays, or else latin-1, so each line
+        # that isn't valid UTF-8 is read as latin-1
+        utf8 = self.path.lower().endswith(".m3u8")
+        with open(self.path, "rb") as f:
+            for line in f:
+                try:
+                    line = line.decode("utf-8", "surrogateescape" if utf8 else "strict")
+                except UnicodeDecodeError:
+                    line = line.decode("latin-1")
+                line = line.strip().lstrip("\ufeff")
+                if line and not line.startswith("#"):
+                    yield line
+
+    def _read(self, count):
+        # parses up to count more entries, False once the file is exhausted
+        for _ in range(count):
+            try:
+                entry = next(self._entries, None)
+            except xml.etree.ElementTree.ParseError as e:
+                # a broken XSPF plays what was read up to the error
+                print("Couldn't read the rest of %s: %s" % (self.path, e))
+                entry = None
+            if entry is None:
+                self._entries = None
+                return False
+            self._starts.append(len(self._data))
+            self._data += entry.encode("utf-8", "surrogateescape")
+        return True
+
+    def load(self):
+        while self._entries is not None and self._read(self.chunk):
+            pass
+        self._loaded()
+
+    def load_async(self):
+        if self._idle_id is None and self._entries is not None:
+            self._idle_id = GLib.idle_add(self._load_chunk, priority = GLib.PRIORITY_LOW)
+        elif self._entries is None:
+            self._loaded()
+
+    def _load_chunk(self):
+        if self._entries is not None and self._read(self.chunk):
+            return True
+        self._idle_id = None
+        self._loaded()
+        return False
+
+    def _loaded(self):
+        if self.loaded:
+            return
+        self.loaded = True
+        if not len(self._starts):
+            print("Empty playlist " + self.path)
+        if self.on_change is not None:
+            self.on_change()
+
+    def close(self):
+        if self._idle_id is not None:
+            GLib.source_remove(self._idle_id)
+            self._idle_id = None
+        if self._entries is not None:
+            self._entries.close()
+            self._entries = None
+
+
+def outward(files, center):
+    # files[center], then alternately the next and previous entries moving away from it
+    for distance in range(max(center + 1, len(files) - center)):
+        for i in ((center,) if distance == 0 else (center + distance, center - distance)):
+            if 0 <= i < len(files):
+                yield files[i]
+
+
+def describe_media(info):
+    # one line for the title bar, e.g. "1920x1080 H.264 / MPEG-4 AAC 0:42:17"
+    parts = []
+    if info.get("width"):
+        parts.append("%dx%d" % (info["width"], info["height"]))
+    codecs = [c for c in (info.get("video_codec"), info.get("audio_codec")) if c]
+    if codecs:
+        parts.append(" / ".join(codecs))
+    if info.get("duration"):
+        parts.append(format_time(info["duration"]))
+    if not info.get("playable", True):
+        parts.append("(unplayable)")
+    return " ".join(parts)
+
+
+class MetadataService:
+    # Probes files with GstPbutils.Discoverer on a bounded pool of worker threads, then
+    # checks that what it found really decodes, at the start and near the end (which
+    # catches truncated files), with a short-lived pipeline. Results land in SQLite
+    # keyed by path + size + mtime, so repeat launches only probe new or changed files.
+    # get() answers from memory and never blocks the main loop; on_result(uri, info) is
+    # called from the main loop as results come in.
+
+    timeout = 10   # seconds allowed per file
+    batch = 500    # playlist entries looked at per main loop callback
+    columns = ("playable", "duration", "width", "height", "bitrate",
+               "video_codec", "audio_codec", "error", "checked")
+    tail = 0.9     # fraction of the duration the end check seeks to
+    tail_slack = 10 * Gst.SECOND   # how far before that the keyframe it lands on may be
+    check_version = 2   # rows checked by an older, weaker decode check are probed again
+
+    def __init__(self, workers = 2, path = None):
+        self.workers = workers
+        self.on_result = None
+        self._db = sqlite3.connect(path or os.path.join(cache_dir(), "metadata.sqlite"),
+                                   check_same_thread = False)
+        self._db_lock = threading.Lock()
+        with self._db_lock, self._db:
+            self._db.execute("CREATE TABLE IF NOT EXISTS metadata (path TEXT PRIMARY KEY, "
+                             "size INTEGER, mtime INTEGER, " + ", ".join(self.columns) + ")")
+            present = [row[1] for row in self._db.execute("PRAGMA table_info(metadata)")]
+            if "checked" not in present:
+                # caches from before the decode check, their rows are probed again
+                self._db.execute("ALTER TABLE metadata ADD COLUMN checked INTEGER")
+        self._pool = ThreadPoolExecutor(workers, "discoverer")
+        self._local = threading.local()
+        self._info = {}        # uri -> info dict
+        self._pending = set()
+        self._feed = None
+        self._fill_id = None
+
+    def get(self, uri):
+        return self._info.get(uri)
+
+    def request(self, uri):
+        if uri in self._info or uri in self._pending or not uri.startswith("file://"):
+            return
+        self._pending.add(uri)
+        self._pool.submit(self._lookup, uri)
+
+    def probe_playlist(self, files, center = 0):
+        # walk the whole playlist outwards from the cursor, a few files in flight at a time
+        self._feed = outward(files, center)
+        self._fill()
+
+    def _fill(self):
+        # at most batch entries per call: streams aren't probed and never fill the
+        # pool, so an http-only playlist would otherwise be walked in one go
+        for _ in range(self.batch):
+            if self._feed is None or len(self._pending) >= self.workers * 2:
+                return
+            uri = next(self._feed, None)
+            if uri is None:
+                self._feed = None
+            else:
+                self.request(uri)
+        if self._fill_id is None:
+            self._fill_id = GLib.idle_add(self._fill_later, priority = GLib.PRIORITY_LOW)
+
+    def _fill_later(self):
+        self._fill_id = None
+        self._fill()
+        return False
+
+    def _lookup(self, uri):
+        # runs on a worker thread
+        info = None
+        try:
+            identity = file_identity(uri)
+            info = self._cached(identity)
+            if info is None:
+                info = self._discover(uri, identity[1])
+                self._store(identity, info)
+        except FileNotFoundError:
+            # a stale playlist entry; not stored, there is no file to key it by
+            info = {"playable": False, "error": "no such file"}
+        except Exception as e:
+            print("Couldn't probe %s: %s" % (uri, e))
+        GLib.idle_add(self._deliver, uri, info)
+
+    def _cached(self, identity):
+        with self._db_lock:
+            row = self._db.execute("SELECT " + ", ".join(self.columns) + " FROM metadata "
+                                   "WHERE path = ? AND size = ? AND mtime = ?", identity).fetchone()
+        if row is None or (row[self.columns.index("checked")] or 0) < self.check_version:
+            return None
+        info = dict(zip(self.columns, row))
+        info["playable"] = bool(info["playable"])
+        return info
+
+    def _store(self, identity, info):
+        values = identity + tuple(info.get(column) for column in self.columns)
+        with self._db_lock, self._db:
+            self._db.execute("INSERT OR REPLACE INTO metadata VALUES (%s)"
+                             % ", ".join("?" * len(values)), values)
+
+    def _discover(self, uri, size):
+        # one Discoverer per worker thread, they are not shared
+        discoverer = getattr(self._local, "discoverer", None)
+        if discoverer is None:
+            discoverer = self._local.discoverer = GstPbutils.Discoverer.new(self.timeout * Gst.SECOND)
+        try:
+            result = discoverer.discover_uri(uri)
+        except GLib.Error as e:
+            return {"playable": False, "error": e.message}
+
+        video = result.get_video_streams()
+        audio = result.get_audio_streams()
+        duration = result.get_duration() or None
+        info = {
+            "playable": result.get_result() == GstPbutils.DiscovererResult.OK and bool(video or audio),
+            "duration": duration,
+            "bitrate": size * 8 * Gst.SECOND // duration if duration else None,
+            "checked": self.check_version,
+        }
+        if info["playable"]:
+            info["error"] = self._check_decoding(uri, "video/x-raw" if video else "audio/x-raw", duration)
+            info["playable"] = info["error"] is None
+        if video:
+            info["width"] = video[0].get_width()
+            info["height"] = video[0].get_height()
+            info["video_codec"] = GstPbutils.pb_utils_get_codec_description(video[0].get_caps())
+        if audio:
+            info["audio_codec"] = GstPbutils.pb_utils_get_codec_description(audio[0].get_caps())
+        return info
+
+    def _check_decoding(self, uri, caps, duration):
+        # None if the main stream decodes at the start and near the end, else why not.
+        # A sink reaching EOS while prerolling completes the preroll without posting
+        # EOS, so every check pulls the preroll sample and looks at where it is.
+        pipeline = Gst.parse_launch("uridecodebin name=decode expose-all-streams=false caps=%s "
+                                    "! appsink name=sink sync=false" % caps)
+        pipeline.get_by_name("decode").set_property("uri", uri)
+        sink = pipeline.get_by_name("sink")
+        bus = pipeline.get_bus()
+        try:
+            positions = [0]
+            if duration:
+                positions.append(int(duration * self.tail))
+            for position in positions:
+                if not position:
+                    pipeline.set_state(Gst.State.PAUSED)
+                elif not pipeline.seek_simple(Gst.Format.TIME, Gst.SeekFlags.FLUSH | Gst.SeekFlags.KEY_UNIT, position):
+                    # not seekable, the start decoding is all we can tell
+                    return None
+                result, state, pending = pipeline.get_state(self.timeout * Gst.SECOND)
+                message = bus.pop_filtered(Gst.MessageType.ERROR)
+                if message is not None:
+                    return message.parse_error()[0].message
+                if result != Gst.StateChangeReturn.SUCCESS:
+                    return "doesn't decode within %d s" % self.timeout
+                sample = sink.emit("try-pull-preroll", 0)
+                if sample is None:
+                    return "truncated, ends before %s" % format_time(position) if position else "nothing decodes"
+                pts = sample.get_buffer().pts
+                if position and pts != Gst.CLOCK_TIME_NONE:
+                    reached = sample.get_segment().to_stream_time(Gst.Format.TIME, pts)
+                    if reached != Gst.CLOCK_TIME_NONE and reached + self.tail_slack < position:
+                        return "truncated, ends at %s" % format_time(reached)
+            return None
+        finally:
+            pipeline.set_state(Gst.State.NULL)
+
+    def forget_unplayable(self):
+        # files found unplayable are probed and checked again when next asked for
+        with self._db_lock, self._db:
+            count = self._db.execute("DELETE FROM metadata WHERE playable = 0").rowcount
+        self._info = dict((uri, info) for uri, info in self._info.items() if info["playable"])
+        return count
+
+    def mark_unplayable(self, uri, error, persist = True):
+        # the player hit an error the probe missed; a stream error is remembered for
+        # good, one that may go away (persist unset) only until the player exits
+        info = dict(self._info.get(uri) or {}, playable = False, error = error, checked = self.check_version)
+        self._info[uri] = info
+        if not persist:
+            return
+        try:
+            self._store(file_identity(uri), info)
+        except (OSError, GLib.Error):
+            pass
+
+    def _deliver(self, uri, info):
+        self._pending.discard(uri)
+        if info is not None:
+            self._info[uri] = info
+            if self.on_result is not None:
+                self.on_result(uri, info)
+        self._fill()
+        return False
+
+    def close(self):
+        self._feed = None
+        if self._fill_id is not None:
+            GLib.source_remove(self._fill_id)
+            self._fill_id = None
+        self._pool.shutdown(wait = False, cancel_futures = True)
+
+
+class FrameGrabber:
+    # Pulls single frames out of a file with its own small pipeline in PAUSED,
+    # without touching the playbin. Only video is decoded, scaled to width pixels
+    # (height follows the aspect ratio unless given) as packed RGB.
+
+    timeout = 5 * Gst.SECOND
+
+    def __init__(self, uri, width, height = None, decoder_threads = 1):
+        size = "width=%d" % width + (",height=%d" % height if height else "")
+        self.pipeline = Gst.parse_launch(
+            "uridecodebin name=decode caps=video/x-raw expose-all-streams=false "
+            "! videoconvert ! videoscale "
+            "! video/x-raw,format=RGB,pixel-aspect-ratio=1/1,%s ! appsink name=sink sync=false" % size)
+        decode = self.pipeline.get_by_name("decode")
+        decode.set_property("uri", uri)
+        self.decoder_threads = decoder_threads
+        self.pipeline.connect("deep-element-added",
+            lambda pipeline, bin, element: set_decoder_threads(element, self.decoder_threads))
+        self.sink = self.pipeline.get_by_name("sink")
+        self.duration = None
+
+    def open(self):
+        self.pipeline.set_state(Gst.State.PAUSED)
+        result, state, pending = self.pipeline.get_state(self.timeout)
+        if result == Gst.StateChangeReturn.FAILURE or state != Gst.State.PAUSED:
+            raise GenericException("Couldn't preroll " + self.pipeline.get_by_name("decode").get_property("uri"))
+        success, duration = self.pipeline.query_duration(Gst.Format.TIME)
+        self.duration = duration if success and duration > 0 else None
+        return self.duration
+
+    def grab(self, position, accurate = False):
+        # Gst.Sample of the frame at position, the previous keyframe unless accurate
+        if accurate:
+            flags = Gst.SeekFlags.FLUSH | Gst.SeekFlags.ACCURATE
+        else:
+            flags = (Gst.SeekFlags.FLUSH | Gst.SeekFlags.KEY_UNIT | Gst.SeekFlags.SNAP_BEFORE |
+                     Gst.SeekFlags.TRICKMODE | Gst.SeekFlags.TRICKMODE_KEY_UNITS)
+        if not self.pipeline.seek_simple(Gst.Format.TIME, flags, int(position)):
+            return None
+        self.pipeline.get_state(self.timeout)
+        return self.sink.emit("try-pull-preroll", self.timeout)
+
+    def close(self):
+        self.pipeline.set_state(Gst.State.NULL)
+
+
+class SpriteSheet:
+    # Seek-preview tiles of one file. The file is a small header followed by packed RGB
+    # tiles one after another, so a tile is a contiguous slice of the memory map.
+
+    header = struct.Struct("<4sIIIQ")   # magic, tile width, tile height, tiles, interval ns
+    magic = b"PVS1"
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        magic, self.width, self.height, self.count, self.interval = self.header.unpack_from(self._map)
+        if magic != self.magic or len(self._map) < self.header.size + self.count * self.width * self.height * 3:
+            self._map.close()
+            raise GenericException("Broken sprite sheet " + path)
+
+    def tile_bytes(self, i):
+        size = self.width * self.height * 3
+        offset = self.header.size + i * size
+        return self._map[offset:offset + size]
+
+    def pixbuf(self, position):
+        i = max(0, min(self.count - 1, int(position // self.interval)))
+        return GdkPixbuf.Pixbuf.new_from_bytes(GLib.Bytes.new(self.tile_bytes(i)),
+            GdkPixbuf.Colorspace.RGB, False, 8, self.width, self.height, self.width * 3)
+
+    def close(self):
+        self._map.close()
+
+    @classmethod
+    def write(cls, path, width, height, interval, tiles):
+        # tiles yields packed RGB bytes, the count is patched in once they are all written;
+        # if tiles raises, nothing is left behind
+        count = 0
+        try:
+            with open(path + ".tmp", "wb") as f:
+                f.write(cls.header.pack(cls.magic, width, height, 0, interval))
+                for tile in tiles:
+                    f.write(tile)
+                    count += 1
+                f.seek(0)
+                f.write(cls.header.pack(cls.magic, width, height, count, interval))
+        except BaseException:
+            os.remove(path + ".tmp")
+            raise
+        os.replace(path + ".tmp", path)
+        return count
+
+
+class BackgroundWorker:
+    # One thread at the lowest CPU priority working through files for the player.
+    # Only the latest request matters: older ones are skipped when dequeued, and the
+    # one in progress is told to give up through cancelled() once another file is
+    # requested. Subclasses implement work(uri, cancelled), returning the result or
+    # None when cancelled; on_ready(uri, result) gets it in the main loop.
+
+    name = "worker"
+    action = "process"   # for the error message, "Couldn't <action> <uri>"
+
+    def __init__(self):
+        self.on_ready = None
+        self._queue = queue.Queue()
+        self._current = None
+        threading.Thread(target = self._run, name = self.name, daemon = True).start()
+
+    def request(self, uri):
+        if uri.startswith("file://"):
+            self._current = uri
+            self._queue.put(uri)
+
+    def close(self):
+        # cancels the file in progress and ends the thread
+        self._current = None
+        self._queue.put(None)
+
+    def _run(self):
+        try:
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 19)
+        except (AttributeError, OSError):
+            pass
+        while True:
+            uri = self._queue.get()
+            if uri is None:
+                return
+            if uri != self._current:
+                continue
+            try:
+                result = self.work(uri, lambda: uri != self._current)
+                if result is not None:
+                    GLib.idle_add(self._deliver, uri, result)
+            except Exception as e:
+                print("Couldn't %s %s: %s" % (self.action, uri, e))
+
+    def work(self, uri, cancelled):
+        raise NotImplementedError
+
+    def _deliver(self, uri, result):
+        if self.on_ready is not None:
+            self.on_ready(uri, result)
+        return False
+
+
+class SceneDetector(BackgroundWorker):
+    # Finds the scene cuts of a file on one background thread: a tiny GRAY8 decode is
+    # pulled from an appsink as fast as the decoder goes and luma histograms of
+    # consecutive frames are compared a block of frames at a time with NumPy. Cuts are
+    # cached per file as an array('q') of [duration, cut, cut, ...] in nanoseconds.
+
+    width = 64
+    height = 36
+    bins = 16
+    block = 256          # frames per vectorized histogram pass
+    threshold = 0.35     # fraction of the histogram that has to change for a cut
+    min_scene = 1 * Gst.SECOND
+
+    name = "scenes"
+    action = "find the scenes of"
+
+    def __init__(self):
+        if numpy is None:
+            raise GenericException("Scene detection needs numpy")
+        # on_ready is called from the main loop with (uri, duration, cuts)
+        BackgroundWorker.__init__(self)
+
+    def work(self, uri, cancelled):
+        return self.detect(uri, cancelled)
+
+    def _deliver(self, uri, chapters):
+        if self.on_ready is not None:
+            self.on_ready(uri, chapters[0], list(chapters[1:]))
+        return False
+
+    def detect(self, uri, cancelled = lambda: False):
+        # array('q') of duration and cut positions of uri, from the cache if possible;
+        # None if cancelled() turned true on the way
+        path = cache_file("chapters", uri, ".chapters")
+        chapters = array.array("q")
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                chapters.frombytes(f.read())
+            return chapters
+        chapters.append(0)
+        pipeline = Gst.parse_launch(
+            "uridecodebin name=decode caps=video/x-raw expose-all-streams=false "
+            "! videoconvert ! videoscale method=nearest-neighbour "
+            "! video/x-raw,format=GRAY8,width=%d,height=%d,pixel-aspect-ratio=1/1 "
+            "! appsink name=sink sync=false max-buffers=%d" % (self.width, self.height, self.block))
+        pipeline.get_by_name("decode").set_property("uri", uri)
+        pipeline.connect("deep-element-added", lambda pipeline, bin, element: self._tune_decoder(element))
+        sink = pipeline.get_by_name("sink")
+        pipeline.set_state(Gst.State.PLAYING)
+        try:
+            previous = None
+            frames, times = [], []
+            while True:
+                if cancelled():
+                    return None
+                sample = sink.emit("try-pull-sample", 10 * Gst.SECOND)
+                if sample is not None:
+                    buffer = sample.get_buffer()
+                    frames.append(buffer.extract_dup(0, self.width * self.height))
+                    times.append(buffer.pts)
+                if frames and (sample is None or len(frames) == self.block):
+                    previous = self._cuts(frames, times, previous, chapters)
+                    frames, times = [], []
+                if sample is None:
+                    break
+            if not sink.get_property("eos"):
+                raise GenericException("decoding failed or stalled")
+            success, duration = pipeline.query_duration(Gst.Format.TIME)
+            chapters[0] = duration if success and duration > 0 else max(0, times[-1] if times else 0)
+        finally:
+            pipeline.set_state(Gst.State.NULL)
+        with open(path + ".tmp", "wb") as f:
+            f.write(chapters.tobytes())
+        os.replace(path + ".tmp", path)
+        return chapters
+
+    @staticmethod
+    def _tune_decoder(element):
+        # every core for the decoder (we run niced) and no B-frames, a cut is still
+        # found within a frame or two
+        set_decoder_threads(element, 0)
+        if element.find_property("skip-frame") is not None:
+            element.set_property("skip-frame", 1)
+
+    def _cuts(self, frames, times, previous, chapters):
+        # appends the cuts in this block to chapters, returns the last histogram
+        pixels = numpy.frombuffer(b"".join(frames), numpy.uint8).reshape(len(frames), -1)
+        bins = (pixels >> (8 - int(math.log2(self.bins)))).astype(numpy.intp)
+        bins += numpy.arange(len(frames))[:, None] * self.bins
+        histograms = numpy.bincount(bins.ravel(), minlength = len(frames) * self.bins).reshape(len(frames), self.bins)
+        if previous is not None:
+            histograms = numpy.vstack((previous, histograms))
+            times = [None] + times
+        change = numpy.abs(numpy.diff(histograms, axis = 0)).sum(axis = 1) / (2.0 * pixels.shape[1])
+        for i in numpy.flatnonzero(change > self.threshold):
+            position = times[i + 1]
+            last = chapters[-1] if len(chapters) > 1 else 0
+            if position != Gst.CLOCK_TIME_NONE and position - last >= self.min_scene:
+                chapters.append(position)
+        return histograms[-1:]
+
+
+class Waveform:
+    # Peak and RMS level of the audio of one file in a fixed number of buckets spread
+    # over its duration. On disk a small header is followed by the two float16 arrays.
+
+    header = struct.Struct("<4sIQ")   # magic, buckets, duration ns
+    magic = b"PVW1"
+
+    def __init__(self, duration, peak, rms):
+        self.duration = duration
+        self.peak = peak
+        self.rms = rms
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as f:
+            data = f.read()
+        magic, count, duration = cls.header.unpack_from(data)
+        if magic != cls.magic or len(data) != cls.header.size + 4 * count:
+            raise GenericException("Broken waveform " + path)
+        levels = numpy.frombuffer(data, numpy.float16, 2 * count, cls.header.size)
+        return cls(duration, levels[:count], levels[count:])
+
+    def save(self, path):
+        with open(path + ".tmp", "wb") as f:
+            f.write(self.header.pack(self.magic, len(self.peak), self.duration))
+            f.write(self.peak.astype(numpy.float16).tobytes())
+            f.write(self.rms.astype(numpy.float16).tobytes())
+        os.replace(path + ".tmp", path)
+
+    def columns(self, width):
+        # (peak, rms) per pixel column of a width pixel wide bar
+        starts = numpy.arange(width) * len(self.peak) // width
+        starts = numpy.minimum(starts, len(self.peak) - 1)
+        peak = numpy.maximum.reduceat(self.peak.astype(numpy.float32), starts)
+        rms = numpy.sqrt(numpy.maximum.reduceat(self.rms.astype(numpy.float32) ** 2, starts))
+        return peak, rms
+
+
+class WaveformService(BackgroundWorker):
+    # Builds the Waveform of the current file on one background thread. Audio alone is
+    # decoded, mixed down to mono at a low rate and pulled from an appsink as fast as
+    # it decodes; each buffer is folded into the running bucket maxima and sums of
+    # squares, so memory stays the same however long the file is.
+
+    buckets = 2048
+    rate = 8000
+    name = "waveform"
+    action = "build the waveform of"
+
+    def __init__(self):
+        if numpy is None:
+            raise GenericException("The waveform needs numpy")
+        # on_ready is called from the main loop with (uri, Waveform)
+        BackgroundWorker.__init__(self)
+
+    def work(self, uri, cancelled):
+        return self.compute(uri, cancelled)
+
+    def compute(self, uri, cancelled = lambda: False):
+        # Waveform of uri, from the cache if possible; None if cancelled() turned true
+        path = cache_file("waveforms", uri, ".wave")
+        if os.path.exists(path):
+            return Waveform.load(path)
+        pipeline = Gst.parse_launch(
+            "uridecodebin name=decode caps=audio/x-raw expose-all-streams=false "
+            "! audioconvert ! audioresample "
+            "! audio/x-raw,format=F32LE,channels=1,rate=%d,layout=interleaved "
+            "! appsink name=sink sync=false" % self.rate)
+        pipeline.get_by_name("decode").set_property("uri", uri)
+        sink = pipeline.get_by_name("sink")
+        try:
+            # prerolled first for the duration, which sets the bucket size
+            pipeline.set_state(Gst.State.PAUSED)
+            result, state, pending = pipeline.get_state(5 * Gst.SECOND)
+            success, duration = pipeline.query_duration(Gst.Format.TIME)
+            if state != Gst.State.PAUSED or not success or duration <= 0:
+                raise GenericException("no audio or unknown duration")
+            total = max(1, duration * self.rate // Gst.SECOND)
+            peak = numpy.zeros(self.buckets, numpy.float32)
+            squares = numpy.zeros(self.buckets, numpy.float64)
+            counts = numpy.zeros(self.buckets, numpy.int64)
+            pipeline.set_state(Gst.State.PLAYING)
+            while True:
+                if cancelled():
+                    return None
+                sample = sink.emit("try-pull-sample", 10 * Gst.SECOND)
+                if sample is None:
+                    break
+                buffer = sample.get_buffer()
+                values = numpy.frombuffer(buffer.extract_dup(0, buffer.get_size()), numpy.float32)
+                if not len(values) or buffer.pts == Gst.CLOCK_TIME_NONE:
+                    continue
+                first = buffer.pts * self.rate // Gst.SECOND
+                index = numpy.minimum((first + numpy.arange(len(values))) * self.buckets // total,
+                                      self.buckets - 1)
+                # index never decreases, so every bucket is one contiguous run
+                starts = numpy.flatnonzero(numpy.diff(index, prepend = -1))
+                buckets = index[starts]
+                peak[buckets] = numpy.maximum(peak[buckets], numpy.maximum.reduceat(numpy.abs(values), starts))
+                squares[buckets] += numpy.add.reduceat(values.astype(numpy.float64) ** 2, starts)
+                counts[buckets] += numpy.diff(numpy.append(starts, len(values)))
+            if not sink.get_property("eos"):
+                raise GenericException("decoding failed or stalled")
+        finally:
+            pipeline.set_state(Gst.State.NULL)
+        waveform = Waveform(duration, peak, numpy.sqrt(squares / numpy.maximum(counts, 1)))
+        waveform.save(path)
+        return waveform
+
+
+class KeyframeIndex:
+    # Sorted keyframe positions of the video of one file and its frame duration, all in
+    # nanoseconds, cached as an array('q') of [frame duration, keyframe, keyframe, ...].
+
+    def __init__(self, frame_duration, keyframes):
+        self.frame_duration = frame_duration
+        self.keyframes = keyframes
+
+    @classmethod
+    def load(cls, path):
+        data = array.array("q")
+        with open(path, "rb") as f:
+            data.frombytes(f.read())
+        if not data:
+            raise GenericException("Broken keyframe index " + path)
+        return cls(data[0], data[1:])
+
+    def save(self, path):
+        data = array.array("q", [self.frame_duration])
+        data.extend(self.keyframes)
+        with open(path + ".tmp", "wb") as f:
+            f.write(data.tobytes())
+        os.replace(path + ".tmp", path)
+
+    def before(self, position):
+        # the keyframe an accurate seek to position has to decode from
+        i = bisect.bisect_right(self.keyframes, position)
+        return self.keyframes[i - 1] if i else 0
+
+    def nearest(self, position):
+        i = bisect.bisect_left(self.keyframes, position)
+        candidates = self.keyframes[max(0, i - 1):i + 1]
+        return min(candidates, key = lambda k: abs(k - position)) if candidates else None
+
+
+class KeyframeIndexer(BackgroundWorker):
+    # Builds the KeyframeIndex of the current file on one background thread. parsebin
+    # only demuxes and parses, nothing is decoded: video buffers without the DELTA_UNIT
+    # flag are the keyframes. Other streams go to a fakesink. on_ready is called
+    # from the main loop with (uri, KeyframeIndex).
+
+    name = "keyframes"
+    action = "index the keyframes of"
+
+    def work(self, uri, cancelled):
+        return self.build(uri, cancelled)
+
+    def build(self, uri, cancelled = lambda: False):
+        # KeyframeIndex of uri, from the cache if possible; None if cancelled() turned true
+        path = cache_file("keyframes", uri, ".keyframes")
+        if os.path.exists(path):
+            return KeyframeIndex.load(path)
+        pipeline = Gst.parse_launch("urisourcebin name=source ! parsebin name=parse "
+                                    "appsink name=sink sync=false max-buffers=64")
+        pipeline.get_by_name("source").set_property("uri", uri)
+        sink = pipeline.get_by_name("sink")
+        pipeline.get_by_name("parse").connect("pad-added", self._on_pad_added, pipeline, sink)
+        keyframes = array.array("q")
+        frames, first, last = 0, None, None
+        pipeline.set_state(Gst.State.PLAYING)
+        try:
+            while True:
+                if cancelled():
+                    return None
+                sample = sink.emit("try-pull-sample", 10 * Gst.SECOND)
+                if sample is None:
+                    break
+                buffer = sample.get_buffer()
+                if buffer.pts == Gst.CLOCK_TIME_NONE:
+                    continue
+                frames += 1
+                first = buffer.pts if first is None else min(first, buffer.pts)
+                last = buffer.pts if last is None else max(last, buffer.pts)
+                if not buffer.has_flags(Gst.BufferFlags.DELTA_UNIT):
+                    keyframes.append(buffer.pts)
+            if not sink.get_property("eos") or not keyframes:
+                raise GenericException("no video or parsing failed")
+        finally:
+            pipeline.set_state(Gst.State.NULL)
+        frame_duration = (last - first) // (frames - 1) if frames > 1 else Gst.SECOND // 25
+        index = KeyframeIndex(frame_duration, array.array("q", sorted(keyframes)))
+        index.save(path)
+        return index
+
+    @staticmethod
+    def _on_pad_added(parse, pad, pipeline, sink):
+        # first video stream to the appsink, the rest is dropped unlinked-error free
+        caps = pad.get_current_caps() or pad.query_caps(None)
+        target = sink.get_static_pad("sink")
+        if not caps.to_string().startswith("video/") or target.is_linked():
+            fakesink = Gst.ElementFactory.make("fakesink")
+            fakesink.set_property("sync", False)
+            pipeline.add(fakesink)
+            fakesink.sync_state_with_parent()
+            target = fakesink.get_static_pad("sink")
+        pad.link(target)
+
+
+class ThumbnailExtractor(BackgroundWorker):
+    # Builds a SpriteSheet per file on one background thread. The thread decodes with
+    # a single decoder thread and idles for duty_cycle times as long as each frame
+    # took, so playback always wins. on_ready is called from the main loop with
+    # (uri, SpriteSheet).
+
+    tile_width = 128
+    max_tiles = 200
+    min_interval = 10 * Gst.SECOND
+    duty_cycle = 3
+    name = "thumbnails"
+    action = "build thumbnails for"
+
+    def work(self, uri, cancelled):
+        try:
+            return self.extract(uri, cancelled)
+        except GenericException:
+            if cancelled():
+                return None
+            raise
+
+    def _deliver(self, uri, path):
+        if self.on_ready is not None:
+            self.on_ready(uri, SpriteSheet(path))
+        return False
+
+    def extract(self, uri, cancelled = None):
+        # build (or reuse) the sprite sheet of uri and return its path; a sheet is only
+        # written whole, a cancel or a frame that can't be grabbed raises GenericException
+        path = cache_file("sprites", uri, ".sprite")
+        if os.path.exists(path):
+            return path
+        grabber = FrameGrabber(uri, self.tile_width)
+        try:
+            duration = grabber.open()
+            if not duration:
+                raise GenericException("unknown duration")
+            count = int(min(self.max_tiles, max(1, duration // self.min_interval)))
+            interval = duration // count
+            first = grabber.grab(0)
+            if first is None:
+                raise GenericException("no video frames")
+            structure = first.get_caps().get_structure(0)
+            width, height = structure.get_value("width"), structure.get_value("height")
+
+            def tiles():
+                sample = first
+                for i in range(count):
+                    if cancelled is not None and cancelled():
+                        raise GenericException("cancelled")
+                    started = time.perf_counter()
+                    if i > 0:
+                        sample = grabber.grab(i * interval)
+                    if sample is None:
+                        raise GenericException("no frame at " + format_time(i * interval))
+                    yield self._packed(sample, width, height)
+                    time.sleep((time.perf_counter() - started) * self.duty_cycle)
+
+            SpriteSheet.write(path, width, height, interval, tiles())
+        finally:
+            grabber.close()
+        return path
+
+    @staticmethod
+    def _packed(sample, width, height):
+        # appsink rows may be padded to 4 bytes, strip that so tiles pack tightly
+        buffer = sample.get_buffer()
+        success, info = buffer.map(Gst.MapFlags.READ)
+        try:
+            data = bytes(info.data)
+        finally:
+            buffer.unmap(info)
+        stride = (width * 3 + 3) & ~3
+        if stride == width * 3:
+            return data[:width * height * 3]
+        return b"".join(data[row * stride:row * stride + width * 3] for row in range(height))
+
+
+def open_playlist(files, ext = (".mp4", ".mkv"), sort = "name", reverse = True):
+    # (playlist, index): a single file brings its directory along, several are played as given
+    if len(files) == 1 and files[0].lower().endswith(PlaylistFile.extensions) and os.path.isfile(files[0]):
+        playlist = PlaylistFile(files[0])
+        # the first entry is read, the rest follows from the main loop
+        playlist.load_async()
+        return playlist, 0
+    if len(files) == 1 and "://" not in files[0]:
+        playlist = Playlist(files[0], ext, sort, reverse)
+        # the rest of the directory is listed while the first video starts
+        playlist.load_async()
+        return playlist, playlist.index_of(files[0])
+    return [f if "://" in f else Gst.filename_to_uri(os.path.abspath(f)) for f in files], 0
+
+
+class InstanceServer:
+    # The running side of single-instance mode: every connection on the socket carries
+    # one JSON line {"files": [...]}, handed to callback(files) in the main loop.
+
+    def __init__(self, callback, path = None):
+        self.callback = callback
+        self.path = path or instance_socket_path()
+        if os.path.exists(self.path):
+            # nobody answered on it or hand_off() would have succeeded
+            os.unlink(self.path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(self.path)
+        self.sock.listen(8)
+        self.sock.setblocking(False)
+        self._source_id = GLib.io_add_watch(self.sock.fileno(), GLib.PRIORITY_DEFAULT,
+                                            GLib.IOCondition.IN, self._on_connection)
+
+    def _on_connection(self, fd, condition):
+        try:
+            conn, address = self.sock.accept()
+        except BlockingIOError:
+            return True
+        with conn:
+            try:
+                conn.settimeout(2)
+                data = b""
+                while not data.endswith(b"\n"):
+                    chunk = conn.recv(64 * 1024)
+                    if not chunk:
+                        break
+                    data += chunk
+                files = json.loads(data)["files"]
+                self._check(files)
+                conn.sendall(b"ok\n")
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                print("Bad single-instance request: " + str(e))
+                try:
+                    conn.sendall(("error " + str(e) + "\n").encode())
+                except OSError:
+                    pass
+                return True
+        if files:
+            # an exception escaping here would remove the watch for good
+            try:
+                self.callback(files)
+            except Exception as e:
+                print("Couldn't open handed over files: " + str(e))
+        return True
+
+    @staticmethod
+    def _check(files):
+        # refused before answering, so the later launch reports the problem itself
+        if not isinstance(files, list) or not all(isinstance(f, str) for f in files):
+            raise ValueError("files must be a list of strings")
+        for f in files:
+            if not (Gst.uri_is_valid(f) if "://" in f else os.path.isfile(f)):
+                raise ValueError("no such file " + f)
+
+    def close(self):
+        GLib.source_remove(self._source_id)
+        self.sock.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+
+class PlaybackStats:
+    # Rolling per-file counters fed from the bus of the active pipeline: QoS (dropped
+    # frames, jitter), buffering stalls, latency, state-change timings and errors.
+    # Rendered/dropped totals come from the video sink's "stats" on every tick. The
+    # JSON snapshot is rebuilt in the main loop and only read by other threads. Only the
+    # max_files most recently opened files keep their own counters, older ones are
+    # summed up in "older" so a session of days doesn't grow the snapshot.
+
+    max_files = 100
+    summed = ("opened", "rendered", "dropped", "qos_messages", "buffering_count", "stall_s", "warnings")
+
+    def __init__(self, videoplayer, interval = 5, log_path = None):
+        self.videoplayer = videoplayer
+        self.interval = interval
+        self.log_path = log_path
+        self.files = {}          # uri -> counters, newest file last
+        self.older = dict((key, 0) for key in ("retired", "errors") + self.summed)
+        self.current = None
+        self.latest = "{}"       # JSON snapshot
+        self._timer_id = None
+        self._stalled = None     # perf_counter() when buffering began
+        self.frame_bytes = None  # (decoded, after downscaling) bytes per frame
+        self._last_state_change = None
+
+    def begin(self, uri):
+        self.current = self.files[uri] = self.files.pop(uri, None) or {
+            "uri": uri,
+            "opened": 0,
+            "rendered": 0,
+            "dropped": 0,
+            "qos_messages": 0,
+            "jitter_max_ms": 0.0,
+            "jitter_mean_ms": 0.0,
+            "buffering_count": 0,
+            "stall_s": 0.0,
+            "latency_ms": None,
+            "state_changes_ms": {},
+            "errors": [],
+            "warnings": 0,
+        }
+        self.current["opened"] += 1
+        while len(self.files) > self.max_files:
+            self._retire(self.files.pop(next(iter(self.files))))
+        self._stalled = None
+        self._last_state_change = time.perf_counter()
+
+    def _retire(self, counters):
+        self.older["retired"] += 1
+        self.older["errors"] += len(counters["errors"])
+        for key in self.summed:
+            self.older[key] += counters[key]
+
+    def on_message(self, message, playbin):
+        counters = self.current
+        if counters is None:
+            return
+        t = message.type
+        if t == Gst.MessageType.QOS:
+            jitter, proportion, quality = message.parse_qos_values()
+            jitter_ms = abs(jitter) / Gst.MSECOND
+            counters["qos_messages"] += 1
+            counters["jitter_max_ms"] = max(counters["jitter_max_ms"], jitter_ms)
+            counters["jitter_mean_ms"] += (jitter_ms - counters["jitter_mean_ms"]) / counters["qos_messages"]
+        elif t == Gst.MessageType.BUFFERING:
+            percent = message.parse_buffering()
+            if percent < 100 and self._stalled is None:
+                self._stalled = time.perf_counter()
+                counters["buffering_count"] += 1
+            elif percent >= 100 and self._stalled is not None:
+                counters["stall_s"] += time.perf_counter() - self._stalled
+                self._stalled = None
+        elif t == Gst.MessageType.LATENCY:
+            query = Gst.Query.new_latency()
+            if playbin.query(query):
+                live, minimum, maximum = query.parse_latency()
+                counters["latency_ms"] = minimum / Gst.MSECOND
+        elif t == Gst.MessageType.STATE_CHANGED and message.src is playbin:
+            old, new, pending = message.parse_state_changed()
+            now = time.perf_counter()
+            name = "%s->%s" % (old.value_nick.upper(), new.value_nick.upper())
+            counters["state_changes_ms"][name] = (now - self._last_state_change) * 1000
+            self._last_state_change = now
+        elif t == Gst.MessageType.ERROR:
+            error, debug = message.parse_error()
+            counters["errors"].append(error.message)
+        elif t == Gst.MessageType.WARNING:
+            counters["warnings"] += 1
+
+    def _poll_sink(self):
+        sink = self.videoplayer.video_sink_element()
+        if self.current is None or sink is None or sink.find_property("stats") is None:
+            return
+        stats = sink.get_property("stats")
+        self.current["rendered"] = stats.get_value("rendered")
+        self.current["dropped"] = stats.get_value("dropped")
+
+    def _poll_scaling(self):
+        if self.current is None or self.frame_bytes is None or None in self.frame_bytes:
+            return
+        decoded, scaled = self.frame_bytes
+        self.current["frame_bytes_decoded"] = decoded
+        self.current["frame_bytes_scaled"] = scaled
+        self.current["frame_bytes_saved"] = decoded - scaled
+
+    def snapshot(self):
+        self._poll_sink()
+        self._poll_scaling()
+        current = dict(self.current) if self.current else None
+        if current is not None and self._stalled is not None:
+            current["stall_s"] += time.perf_counter() - self._stalled
+        snapshot = {"time": time.time(), "current": current, "files": list(self.files.values()),
+                    "older": dict(self.older)}
+        if self.videoplayer.frame_cache is not None:
+            snapshot["frame_cache"] = self.videoplayer.frame_cache.counters()
+        return snapshot
+
+    def start_reporting(self):
+        if self._timer_id is None:
+            self._timer_id = GLib.timeout_add(int(self.interval * 1000), self._report)
+
+    def _report(self):
+        snapshot = self.snapshot()
+        self.latest = json.dumps(snapshot)
+        if self.log_path:
+            with open(self.log_path, "a") as log:
+                log.write(json.dumps({"time": snapshot["time"], "current": snapshot["current"]}) + "\n")
+        return True
+
+
+class MetricsServer:
+    # Serves the latest PlaybackStats snapshot as JSON on 127.0.0.1 for a local scraper.
+
+    def __init__(self, stats, port):
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = stats.latest.encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = http.server.ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        threading.Thread(target = self.httpd.serve_forever, name = "metrics", daemon = True).start()
+
+    def close(self):
+        self.httpd.shutdown()
+
+
+class SinkProbe:
+    # Times the installed video sinks and decoder thread counts on a short synthetic
+    # clip, once per machine, and remembers the fastest in the cache. Sinks render
+    # into window_handle while probed so none of them opens a window of its own.
+
+    sinks = ("xvimagesink", "ximagesink", "glimagesink", "d3d11videosink", "d3dvideosink")
+    thread_counts = (0, 1, 2, 4, 8)
+    clip_seconds = 4
+
+    def __init__(self, path = None):
+        self.path = path or os.path.join(cache_dir(), "sinkprobe.json")
+        self.window_handle = None
+
+    def _machine(self):
+        return "%s %s cpus=%d %s" % (platform.node(), platform.machine(),
+                                     os.cpu_count() or 1, Gst.version_string())
+
+    def cached(self):
+        # the remembered result for this machine, None if it has to be probed
+        try:
+            with open(self.path) as f:
+                cached = json.load(f)
+            if cached.get("machine") == self._machine():
+                return cached
+        except (OSError, ValueError):
+            pass
+        return None
+
+    def result(self, window_handle = None):
+        # {"video-sink": name or None, "max-threads": n or None}; probing takes
+        # seconds, so call it from a worker thread when there is nothing cached
+        cached = self.cached()
+        if cached is not None:
+            return cached
+        self.window_handle = window_handle
+        try:
+            result = self.run()
+        except GenericException as e:
+            print("Sink probe failed: " + str(e))
+            return {}
+        result["machine"] = self._machine()
+        with open(self.path, "w") as f:
+            json.dump(result, f, indent = 2)
+        return result
+
+    def run(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            clip = make_test_clip(os.path.join(tmp, "probe.mkv"), self.clip_seconds, 1280, 720)
+            # video only, the clip has an audio track the fakesink could get linked to
+            source = ("uridecodebin uri=\"%s\" caps=video/x-raw expose-all-streams=false ! "
+                      % Gst.filename_to_uri(clip))
+
+            threads = {}
+            for count in self.thread_counts:
+                elapsed = self._time(source + "fakesink sync=false", count)
+                if elapsed is not None:
+                    threads[count] = elapsed
+            best_threads = min(threads, key = threads.get) if threads else None
+
+            sinks = {}
+            for name in self.sinks:
+                if Gst.ElementFactory.find(name) is None:
+                    continue
+                elapsed = self._time(source + "videoconvert ! %s sync=false" % name, best_threads)
+                if elapsed is not None:
+                    sinks[name] = elapsed
+            best_sink = min(sinks, key = sinks.get) if sinks else None
+
+        print("sink probe: %s, decoder max-threads %s" % (best_sink, best_threads))
+        return {"video-sink": best_sink, "max-threads": best_threads,
+                "sinks_s": sinks, "threads_s": dict((str(k), v) for k, v in threads.items())}
+
+    def _time(self, description, threads):
+        try:
+            pipeline = Gst.parse_launch(description)
+        except GLib.Error:
+            return None
+        pipeline.connect("deep-element-added",
+            lambda pipeline, bin, element: set_decoder_threads(element, threads))
+        bus = pipeline.get_bus()
+        if self.window_handle is not None:
+            bus.enable_sync_message_emission()
+            bus.connect("sync-message::element", self._on_sync_element_message)
+        started = time.perf_counter()
+        pipeline.set_state(Gst.State.PLAYING)
+        message = bus.timed_pop_filtered(30 * Gst.SECOND, Gst.MessageType.EOS | Gst.MessageType.ERROR)
+        elapsed = time.perf_counter() - started
+        pipeline.set_state(Gst.State.NULL)
+        if message is None or message.type != Gst.MessageType.EOS:
+            return None
+        return elapsed
+
+    def _on_sync_element_message(self, bus, message):
+        if message.get_structure().get_name() == 'prepare-window-handle':
+            message.src.set_window_handle(self.window_handle)
+
+
+class PositionTracker:
+    # Drives the progress slider from a single GLib timer. The duration is cached
+    # from DURATION_CHANGED/ASYNC_DONE bus messages so a tick only queries the position,
+    # and the tick rate follows how far the knob moves per pixel.
+
+    min_interval = 40      # ms
+    max_interval = 1000    # ms
+
+    def __init__(self, videoplayer, slider, handler_id):
+        self.videoplayer = videoplayer
+        self.slider = slider
+        self.handler_id = handler_id
+        self.duration = None   # nanoseconds, None while unknown
+        self.visible = True
+        self._running = False
+        self._timer_id = None
+        self._interval = self.max_interval
+        if slider is not None:
+            slider.connect('size-allocate', lambda *_: self._reschedule())
+
+    def reset(self, duration = None):
+        # the active pipeline now plays another file, duration if already known
+        self.duration = duration
+        if self.slider is not None:
+            # the fill level marks what has been downloaded of a stream, local files are all there
+            streaming = self.videoplayer.streaming
+            self.slider.set_show_fill_level(streaming)
+            self.slider.set_restrict_to_fill_level(False)
+            self.slider.set_fill_level(0 if streaming else 100)
+        self._reschedule()
+
+    def on_message(self, message):
+        if message.type in (Gst.MessageType.DURATION_CHANGED, Gst.MessageType.ASYNC_DONE):
+            self._query_duration()
+            self._reschedule()
+        if message.type == Gst.MessageType.ASYNC_DONE and not self._running and self.slider is not None:
+            # paused: no timer runs, show where a seek or frame step landed
+            success, position = self.videoplayer.player.query_position(Gst.Format.TIME)
+            if success and self.duration:
+                self.set_position(position)
+
+    def start(self):
+        self._running = True
+        self._reschedule()
+
+    def stop(self):
+        self._running = False
+        self._reschedule()
+
+    def set_visible(self, visible):
+        self.visible = visible
+        self._reschedule()
+
+    def _query_duration(self):
+        success, duration = self.videoplayer.player.query_duration(Gst.Format.TIME)
+        self.duration = duration if success and duration > 0 else None
+
+    def _pick_interval(self):
+        width = self.slider.get_allocated_width() if self.slider is not None else 0
+        if not self.duration or width <= 1:
+            return self.max_interval
+        per_pixel = self.duration / Gst.MSECOND / width / abs(self.videoplayer.rate)
+        return int(min(self.max_interval, max(self.min_interval, per_pixel)))
+
+    def _reschedule(self):
+        # headless players (no slider) only keep the cached duration
+        wanted = self._running and self.visible and self.slider is not None
+        interval = self._pick_interval()
+        if self._timer_id is not None and (not wanted or interval != self._interval):
+            GLib.source_remove(self._timer_id)
+            self._timer_id = None
+        if wanted and self._timer_id is None:
+            self._interval = interval
+            self._timer_id = GLib.timeout_add(interval, self._tick)
+
+    def _tick(self):
+        if self.duration is None:
+            self._query_duration()
+        success, position = self.videoplayer.player.query_position(Gst.Format.TIME)
+        if success and self.duration and not self.videoplayer.scrubber.dragging:
+            self.set_position(position)
+        self.update_buffered()
+        if self._pick_interval() != self._interval:
+            # returning False drops this source, _reschedule adds one at the new rate
+            self._timer_id = None
+            self._reschedule()
+            return False
+        return True
+
+    def update_buffered(self):
+        if self.slider is not None and self.videoplayer.streaming:
+            percent = self.videoplayer.buffered_percent()
+            if percent is not None:
+                self.slider.set_fill_level(percent)
+
+    def set_position(self, position):
+        # block seek handler so we don't seek when we set_value()
+        self.slider.handler_block(self.handler_id)
+        self.slider.set_value(float(position) / self.duration * 100)
+        self.slider.handler_unblock(self.handler_id)
+
+
+class Scrubber:
+    # Keeps at most one flushing seek in flight on the active pipeline. Requests that
+    # arrive meanwhile overwrite a single pending slot which is issued once ASYNC_DONE
+    # reports the running seek complete, so dragging the slider never queues up seeks.
+
+    timeout = 2000   # ms before an unanswered seek stops blocking the next one
+
+    def __init__(self, videoplayer):
+        self.videoplayer = videoplayer
+        self.dragging = False
+        self.latencies = []      # seconds from issuing a seek to its first frame
+        self._pending = None     # (position, flags)
+        self._issued = None      # perf_counter() of the seek in flight
+        self._timeout_id = None
+
+    def seek(self, position, accurate = False):
+        if accurate:
+            flags = Gst.SeekFlags.FLUSH | Gst.SeekFlags.ACCURATE
+        elif self.dragging:
+            flags = Gst.SeekFlags.FLUSH | Gst.SeekFlags.KEY_UNIT | Gst.SeekFlags.SNAP_NEAREST
+        else:
+            position, flags = self.videoplayer.plan_seek(position)
+        self._pending = (max(0, int(position)), flags)
+        if self._issued is None:
+            self._issue()
+
+    def cancel(self):
+        self._pending = None
+        self._done()
+
+    def on_message(self, message):
+        if message.type == Gst.MessageType.ASYNC_DONE and self._issued is not None:
+            latency = time.perf_counter() - self._issued
+            self.latencies.append(latency)
+            print('seek latency: %.1f ms' % (latency * 1000))
+            self._done()
+            if self._pending is not None:
+                self._issue()
+
+    def _issue(self):
+        position, flags = self._pending
+        self._pending = None
+        if self.videoplayer.seek_to(position, flags):
+            self._issued = time.perf_counter()
+            self._timeout_id = GLib.timeout_add(self.timeout, self._on_timeout)
+
+    def _done(self):
+        self._issued = None
+        if self._timeout_id is not None:
+            GLib.source_remove(self._timeout_id)
+            self._timeout_id = None
+
+    def _on_timeout(self):
+        self._timeout_id = None
+        self._issued = None
+        if self._pending is not None:
+            self._issue()
+        return False
+
+
+class FrameTap:
+    # Hands the frames of the active pipeline to analysis plugins as NumPy arrays.
+    # A tee in playbin's video-filter feeds a one-buffer leaky queue and an appsink
+    # that takes the decoder's own format; samples wait in a bounded deque that drops
+    # the oldest when the plugins fall behind, so analysis never holds up playback.
+    # Plugins run on the tap's own thread as plugin(frame, timestamp) with frame a
+    # (height, width[, channels]) uint8 view of the mapped buffer, only valid during
+    # the call. GRAY8 is the luma plane of the usual YUV formats and needs no copy;
+    # anything else is converted on the tap thread, and only for frames delivered.
+
+    channels = {"GRAY8": 1, "RGB": 3, "BGR": 3, "RGBx": 4, "BGRx": 4, "RGBA": 4, "BGRA": 4}
+    # formats whose first plane is 8 bit luma, served as GRAY8 as they are
+    luma_formats = ("GRAY8", "I420", "YV12", "NV12", "NV21", "NV16", "NV24", "Y41B", "Y42B", "Y444")
+
+    def __init__(self, format = "GRAY8", queue_size = 4):
+        if numpy is None:
+            raise GenericException("The frame tap needs numpy")
+        if format not in self.channels:
+            raise GenericException("Unsupported frame tap format " + format)
+        self.format = format
+        self.plugins = []
+        self.delivered = 0
+        self.dropped = 0
+        self.converted = 0       # frames that weren't in the wanted format already
+        self.active = None       # playbin whose frames are delivered, set by VideoPlayer
+        self._samples = collections.deque(maxlen = queue_size)
+        self._wakeup = threading.Condition()
+        self._closed = False
+        threading.Thread(target = self._run, daemon = True).start()
+
+    def add_plugin(self, plugin):
+        self.plugins.append(plugin)
+
+    def remove_plugin(self, plugin):
+        self.plugins.remove(plugin)
+
+    def make_branch(self, playbin):
+        # bin to link to a tee src pad in the video-filter of playbin
+        # no videoconvert here: it would run on every frame, dropped ones included
+        branch = Gst.parse_bin_from_description(
+            "queue leaky=downstream max-size-buffers=1 max-size-bytes=0 max-size-time=0 ! "
+            "appsink name=tap caps=video/x-raw emit-signals=true sync=false async=false "
+            "max-buffers=1 drop=true", True)
+        branch.get_by_name("tap").connect("new-sample", self._on_new_sample, playbin)
+        return branch
+
+    def _on_new_sample(self, appsink, playbin):
+        # streaming thread: queue it and return right away
+        sample = appsink.emit("pull-sample")
+        if sample is None or playbin is not self.active or not self.plugins:
+            return Gst.FlowReturn.OK
+        with self._wakeup:
+            if len(self._samples) == self._samples.maxlen:
+                self.dropped += 1
+            self._samples.append(sample)
+            self._wakeup.notify()
+        return Gst.FlowReturn.OK
+
+    def _run(self):
+        while True:
+            with self._wakeup:
+                while not self._samples and not self._closed:
+                    self._wakeup.wait()
+                if self._closed:
+                    return
+                sample = self._samples.popleft()
+            self._deliver(sample)
+
+    def _deliver(self, sample):
+        info = GstVideo.VideoInfo()
+        if not info.from_caps(sample.get_caps()):
+            return
+        native = info.finfo.name
+        if native != self.format and not (self.format == "GRAY8" and native in self.luma_formats):
+            sample = GstVideo.video_convert_sample(sample,
+                Gst.Caps.from_string("video/x-raw,format=%s" % self.format), Gst.SECOND)
+            if sample is None or not info.from_caps(sample.get_caps()):
+                return
+            self.converted += 1
+        buffer = sample.get_buffer()
+        success, mapped = buffer.map(Gst.MapFlags.READ)
+        if not success:
+            return
+        frame = None
+        try:
+            channels = self.channels[self.format]
+            shape = (info.height, info.width, channels) if channels > 1 else (info.height, info.width)
+            strides = (info.stride[0], channels, 1) if channels > 1 else (info.stride[0], 1)
+            frame = numpy.ndarray(shape, numpy.uint8, mapped.data, info.offset[0], strides)
+            for plugin in list(self.plugins):
+                plugin(frame, buffer.pts)
+            self.delivered += 1
+        finally:
+            del frame
+            buffer.unmap(mapped)
+
+    def close(self):
+        with self._wakeup:
+            self._closed = True
+            self._samples.clear()
+            self._wakeup.notify()
+
+
+class BlackFrameDetector:
+    # FrameTap plugin printing where runs of black frames begin and end
+
+    def __init__(self, threshold = 24, coverage = 0.98):
+        self.threshold = threshold   # luma at or below counts as black
+        self.coverage = coverage     # fraction of pixels that have to be black
+        self.started = None
+
+    def __call__(self, frame, timestamp):
+        if frame.ndim > 2:
+            frame = frame[:, :, :3].max(axis = 2)
+        black = numpy.count_nonzero(frame <= self.threshold) >= self.coverage * frame.size
+        if black and self.started is None:
+            self.started = timestamp
+            print('black from %s' % format_time(timestamp))
+        elif not black and self.started is not None:
+            print('black until %s' % format_time(timestamp))
+            self.started = None
+
+
+class FrameCache:
+    # Copies of the frames the active pipeline most recently decoded, keyed by
+    # timestamp, kept least recently used first within capacity bytes. A buffer probe
+    # at the end of playbin's video-filter fills it from the streaming thread; frames
+    # are copied so the decoder's buffer pool never waits on the cache. While playing
+    # (paused unset, VideoPlayer sets it) only playing_share of capacity is used, a
+    # ring of the frames just shown, so the steps back right after a pause don't need
+    # the decoder; while paused, frame steps and seeks may fill all of it.
+
+    playing_share = 0.25
+
+    def __init__(self, megabytes = 64):
+        self.capacity = megabytes * 1024 * 1024
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.active = None       # playbin whose frames are kept, set by VideoPlayer
+        self.paused = False
+        self._frames = collections.OrderedDict()   # pts -> (buffer, caps)
+        self._positions = []     # the same pts, sorted
+        self._lock = threading.Lock()
+
+    def probe(self, pad, info, playbin):
+        buffer = info.get_buffer()
+        caps = pad.get_current_caps()
+        if playbin is not self.active or caps is None or buffer.pts == Gst.CLOCK_TIME_NONE:
+            return Gst.PadProbeReturn.OK
+        copy = buffer.copy_deep()
+        capacity = self.capacity if self.paused else int(self.capacity * self.playing_share)
+        with self._lock:
+            old = self._frames.pop(buffer.pts, None)
+            if old is not None:
+                self.size -= old[0].get_size()
+            else:
+                bisect.insort(self._positions, buffer.pts)
+            self._frames[buffer.pts] = (copy, caps)
+            self.size += copy.get_size()
+            while self.size > capacity and self._frames:
+                pts, (evicted, evicted_caps) = self._frames.popitem(last = False)
+                self.size -= evicted.get_size()
+                del self._positions[bisect.bisect_left(self._positions, pts)]
+        return Gst.PadProbeReturn.OK
+
+    def lookup(self, position, tolerance):
+        # Gst.Sample of the cached frame closest to position within tolerance, or None
+        with self._lock:
+            i = bisect.bisect_left(self._positions, position)
+            candidates = self._positions[max(0, i - 1):i + 1]
+            pts = min(candidates, key = lambda p: abs(p - position), default = None)
+            if pts is None or abs(pts - position) > tolerance:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._frames.move_to_end(pts)
+            buffer, caps = self._frames[pts]
+        return Gst.Sample.new(buffer, caps, None, None)
+
+    def clear(self):
+        with self._lock:
+            self._frames.clear()
+            self._positions = []
+            self.size = 0
+
+    def counters(self):
+        lookups = self.hits + self.misses
+        return {"frames": len(self._frames), "bytes": self.size, "hits": self.hits,
+                "misses": self.misses, "hit_rate": self.hits / lookups if lookups else None}
+
+
 class VideoPlayer:
 
     is_fullscreen = False
     is_playing = False 
+    # playback rates stepped through with [ and ], beyond 2x only keyframes are decoded
+    rates = (-32, -16, -8, -4, -2, -1, 0.5, 1, 1.5, 2, 4, 8, 16, 32)
+    rate = 1.0
+    # GstPlayFlags bit that has playbin render video
+    PLAY_FLAG_VIDEO = 1 << 0
+    # and the one that has it download http(s) streams into a (ring) buffer file
+    PLAY_FLAG_DOWNLOAD = 1 << 7
+    # with a keyframe index, seeks within this of a keyframe land on it, the rest decode
+    # from the keyframe before to the exact position
+    snap_tolerance = Gst.SECOND // 2
+    seek_decode_cost = 0   # ns decoded ahead of the target by the last planned seek
+    video_hidden = False
+    _direction = 1   # +1 or -1, which way the last next/previous went
+    _iconified = False
+    _obscured = False
+    _zero_sized = False
     
-    def __init__(self, builder, window, canvas, filelist, index = 0):
+    # builder, window and canvas may all be None to run headless, e.g. with
+    # video_sink = audio_sink = "fakesink" from the benchmark
+    def __init__(self, builder, window, canvas, filelist, index = 0, preload = 0,
+                 video_sink = None, audio_sink = None, metadata = None, thumbnails = None,
+                 decoder_threads = None, sink_probe = None, downscale = False,
+                 ring_buffer_size = 0, buffer_size = -1, buffer_duration = -1, frame_tap = None,
+                 scenes = None, waveforms = None, keyframes = None, frame_cache = None):
         self.builder = builder
         self.window = window
         self._canvas = canvas
         self.files = filelist 
         self.index = index
+        # number of neighbours on each side kept pre-rolled in PAUSED, 0 disables
+        self.preload = preload
+        self.video_sink = video_sink
+        self.audio_sink = audio_sink
+        self.decoder_threads = decoder_threads
+        # optional SinkProbe, fills in whichever of the two above wasn't given
+        self.sink_probe = sink_probe
+        # scale decoded frames down to the canvas size before conversion and upload
+        self.downscale = downscale and canvas is not None
+        # download buffering of http(s) uris: bytes kept on disk (0 = the whole file),
+        # bytes and nanoseconds to buffer before playing (-1 = playbin's defaults)
+        self.ring_buffer_size = ring_buffer_size
+        self.buffer_size = buffer_size
+        self.buffer_duration = buffer_duration
+        # optional MetadataService, supplies durations and flags unplayable files
+        self.metadata = metadata
+        # optional ThumbnailExtractor for the seek preview on the slider
+        self.thumbnails = thumbnails
+        self._sprite = None
+        # optional FrameTap feeding decoded frames to analysis plugins
+        self.frame_tap = frame_tap
+        # optional SceneDetector, its cuts become chapter marks on the slider
+        self.scenes = scenes
+        self.chapters = []
+        self._marks_duration = None
+        self.clip_in = None      # range export_clip() remuxes, in ns
+        self.clip_out = None
+        self.exporter = None     # ClipExporter while one runs
+        # optional WaveformService, its overview is drawn behind the slider
+        self.waveforms = waveforms
+        self._waveform = None
+        # optional KeyframeIndexer, lets seeks land exactly where asked
+        self.keyframe_indexer = keyframes
+        self.keyframes = None
+        # optional FrameCache, frame steps and small scrubs are shown from it
+        self.frame_cache = frame_cache
+        self._cached_position = None   # pts of the cached frame on the canvas, if any
+        self._cached_pixbuf = None
         
         self._setupplayer()
         
-        self.playpause_button = builder.get_object("playpause_togglebutton")
-        self.slider = builder.get_object("progress")
-        self.slider_handler_id = self.slider.connect("value-changed", self.on_slider_seek)
+        self.playpause_button = None
+        self.slider = None
+        self.slider_handler_id = None
+        if builder is not None:
+            self.playpause_button = builder.get_object("playpause_togglebutton")
+            self.slider = builder.get_object("progress")
+            self.slider_handler_id = self.slider.connect("value-changed", self.on_slider_seek)
+            self.slider.connect("button-press-event", self._on_slider_press)
+            self.slider.connect("button-release-event", self._on_slider_release)
+            if thumbnails is not None:
+                self.slider.set_has_tooltip(True)
+                self.slider.connect("query-tooltip", self._on_slider_tooltip)
+            if waveforms is not None:
+                self.slider.connect("draw", self._on_slider_draw)
+        self.tracker = PositionTracker(self, self.slider, self.slider_handler_id)
+        self.scrubber = Scrubber(self)
+        self.stats = PlaybackStats(self)
+        if window is not None:
+            self.window.connect("window-state-event", self._on_window_state_event)
+            self.window.add_events(Gdk.EventMask.VISIBILITY_NOTIFY_MASK)
+            self.window.connect("visibility-notify-event", self._on_visibility_notify)
+        if canvas is not None:
+            canvas.connect("size-allocate", self._on_canvas_size_allocate)
+            if frame_cache is not None:
+                canvas.connect("draw", self._on_canvas_draw)
+        if isinstance(filelist, (Playlist, PlaylistFile)):
+            filelist.on_change = self._on_playlist_changed
+        if metadata is not None:
+            metadata.on_result = self._on_metadata
+        if thumbnails is not None:
+            thumbnails.on_ready = self._on_thumbnails
+        if scenes is not None:
+            scenes.on_ready = self._on_chapters
+        if waveforms is not None:
+            waveforms.on_ready = self._on_waveform
+        if keyframes is not None:
+            keyframes.on_ready = self._on_keyframes
         
     
     def _setupplayer(self):
         # The element with the set_window_handle function will be stored here
         self._video_overlay = None
-        self.player = Gst.ElementFactory.make("playbin", "MultimediaPlayer")
+        self._overlays = {}      # playbin -> its video overlay element
+        self._scalers = {}       # playbin -> capsfilter after its downscaling videoscale
+        self._rescale_id = None
+        self._preloaded = {}     # playlist index -> playbin sitting in PAUSED
+        self._active_index = self.index
+        self._switch_started = None
+        self.switch_latencies = []   # seconds, one entry per nextVideo/previousVideo
+        self._start_called = None
+        self.first_frame_latency = None   # seconds from start() to PLAYING
+        self._buffering = False  # active pipeline held in PAUSED until its buffer refills
+        self.player = self._make_playbin()
+        if self.frame_tap is not None:
+            self.frame_tap.active = self.player
+        if self.frame_cache is not None:
+            self.frame_cache.active = self.player
         self._setup_signal_handlers()
         
+    def _make_playbin(self, name="MultimediaPlayer"):
+        playbin = Gst.ElementFactory.make("playbin", name)
+        if self.video_sink:
+            playbin.set_property("video-sink", Gst.ElementFactory.make(self.video_sink))
+        if self.audio_sink:
+            playbin.set_property("audio-sink", Gst.ElementFactory.make(self.audio_sink))
+        if Gst.ElementFactory.find("scaletempo") is not None:
+            # keeps the pitch of the audio at 0.5x-2x
+            playbin.set_property("audio-filter", Gst.ElementFactory.make("scaletempo"))
+        playbin.connect("element-setup",
+            lambda playbin, element: set_decoder_threads(element, self.decoder_threads))
+        video_filter = self._make_video_filter(playbin)
+        if video_filter is not None:
+            playbin.set_property("video-filter", video_filter)
+        bus = playbin.get_bus()
+        bus.enable_sync_message_emission()
+        bus.connect('sync-message::element', self._on_sync_element_message, playbin)
+        bus.add_signal_watch()
+        bus.connect('message', self._on_bus_message, playbin)
+        return playbin
+
+    def _make_video_filter(self, playbin):
+        # playbin's video-filter sits between the decoder and playsink's own
+        # conversion, a bin of whichever stages are enabled
+        stages = []
+        tee = None
+        if self.frame_tap is not None:
+            # ahead of any scaling, so plugins see the frames as decoded
+            tee = Gst.ElementFactory.make("tee")
+            stages.append(tee)
+        if self.downscale:
+            scale = Gst.ElementFactory.make("videoscale")
+            capsfilter = Gst.ElementFactory.make("capsfilter")
+            capsfilter.set_property("caps", self._canvas_caps())
+            capsfilter.get_static_pad("src").connect("notify::caps", self._on_scaled_caps, playbin, scale)
+            self._scalers[playbin] = capsfilter
+            stages += [scale, capsfilter]
+        if self.frame_cache is not None and not stages:
+            stages.append(Gst.ElementFactory.make("identity"))
+        if not stages:
+            return None
+        video_filter = Gst.Bin.new(None)
+        for element in stages:
+            video_filter.add(element)
+        for upstream, downstream in zip(stages, stages[1:]):
+            upstream.link(downstream)
+        if tee is not None:
+            branch = self.frame_tap.make_branch(playbin)
+            video_filter.add(branch)
+            tee.link(branch)
+        last = stages[-1]
+        src = last.get_static_pad("src") if last is not tee else tee.get_request_pad("src_%u")
+        video_filter.add_pad(Gst.GhostPad.new("sink", stages[0].get_static_pad("sink")))
+        video_filter.add_pad(Gst.GhostPad.new("src", src))
+        if self.frame_cache is not None:
+            # after downscaling, so the cache holds as many frames as possible
+            video_filter.get_static_pad("src").add_probe(Gst.PadProbeType.BUFFER, self.frame_cache.probe, playbin)
+        return video_filter
+
+    def _canvas_caps(self):
+        # frames no larger than the canvas in device pixels; videoscale keeps the
+        # aspect ratio inside the ranges and passes smaller videos through untouched
+        scale = self._canvas.get_scale_factor()
+        width = self._canvas.get_allocated_width() * scale
+        height = self._canvas.get_allocated_height() * scale
+        if width <= 1 or height <= 1:
+            return Gst.Caps.from_string("video/x-raw")
+        return Gst.Caps.from_string("video/x-raw,width=[1,%d],height=[1,%d]" % (width, height))
+
+    def _schedule_rescale(self):
+        # resizes come in bursts, renegotiate once they settle
+        if self.downscale and self._rescale_id is None:
+            self._rescale_id = GLib.timeout_add(250, self._rescale)
+
+    def _rescale(self):
+        self._rescale_id = None
+        caps = self._canvas_caps()
+        for capsfilter in self._scalers.values():
+            if not caps.is_equal(capsfilter.get_property("caps")):
+                capsfilter.set_property("caps", caps)
+        return False
+
+    def _on_scaled_caps(self, pad, pspec, playbin, scale):
+        # streaming thread: record how much smaller the frames got
+        if playbin is not self.player:
+            return
+        sizes = []
+        for caps in (scale.get_static_pad("sink").get_current_caps(), pad.get_current_caps()):
+            info = GstVideo.VideoInfo()
+            sizes.append(info.size if caps is not None and info.from_caps(caps) else None)
+        self.stats.frame_bytes = tuple(sizes)
+
+    def _load(self, playbin, uri):
+        # every uri goes through here so streams get their download buffering
+        flags = int(playbin.get_property("flags"))
+        if is_stream(uri):
+            flags |= self.PLAY_FLAG_DOWNLOAD
+            playbin.set_property("ring-buffer-max-size", self.ring_buffer_size)
+            playbin.set_property("buffer-size", self.buffer_size)
+            playbin.set_property("buffer-duration", self.buffer_duration)
+        else:
+            flags &= ~self.PLAY_FLAG_DOWNLOAD
+        playbin.set_property("flags", flags)
+        playbin.set_property("uri", uri)
+
+    @property
+    def streaming(self):
+        return is_stream(self.player.get_property("uri"))
+
+    def buffered_percent(self):
+        # end of the downloaded range the playback position is in, as percent of the file
+        query = Gst.Query.new_buffering(Gst.Format.PERCENT)
+        if not self.player.query(query):
+            return None
+        format, start, stop, estimated_total = query.parse_buffering_range()
+        ranges = [query.parse_nth_buffering_range(i)[1:] for i in range(query.get_n_buffering_ranges())]
+        if self.tracker.duration:
+            position = self.current_position() * Gst.FORMAT_PERCENT_MAX // self.tracker.duration
+            stop = next((end for begin, end in ranges if begin <= position <= end), stop)
+        if stop < 0:
+            return None
+        return stop * 100 / Gst.FORMAT_PERCENT_MAX
+
+    def _on_buffering(self, percent):
+        # hold the pipeline in PAUSED while its buffer refills; is_playing keeps
+        # what the user asked for so playback resumes by itself at 100%
+        if percent < 100 and not self._buffering:
+            self._buffering = True
+            print('buffering...')
+            if self.is_playing:
+                self.player.set_state(Gst.State.PAUSED)
+        elif percent >= 100 and self._buffering:
+            self._buffering = False
+            print('buffering done')
+            if self.is_playing:
+                self.player.set_state(Gst.State.PLAYING)
+        self.tracker.update_buffered()
+
+    def _file(self, index):
+        # uri of files[index] for a pipeline to open; a PlaylistFile remembers it so
+        # index_of() finds it again without a search
+        uri = self.files[index]
+        if isinstance(self.files, PlaylistFile):
+            self.files.remember(uri, index)
+        return uri
+
+    def _drop_playbin(self, playbin):
+        playbin.set_state(Gst.State.NULL)
+        playbin.get_bus().remove_signal_watch()
+        self._overlays.pop(playbin, None)
+        self._scalers.pop(playbin, None)
+
     def setup_player(self,f):
         # file to play must be transmitted as uri
         dialog = Gtk.FileChooserDialog("Please choose a file", self.window,
@@ -124,25 +2396,494 @@ class VideoPlayer:
             
         uri = dialog.get_uri()
         dialog.destroy()
-        self.player.set_property("uri", uri)
+        if response != Gtk.ResponseType.OK or uri is None:
+            return
+        # the same steps as _openVideo() for a file that needn't be in the playlist; its
+        # pipeline isn't kept as a preloaded neighbour once Left/Right move on
+        self._active_index = None
+        self._begin_file(uri)
+        self._buffering = False
+        self.player.set_state(Gst.State.NULL)
+        self._load(self.player, uri)
+        self.rate = 1.0
+        self.tracker.reset()
+        self.scrubber.cancel()
+        self._leave_cached_frame()
+        if self.frame_cache is not None:
+            self.frame_cache.clear()
+        self.play()
         
     def _setup_signal_handlers(self):
-        self._canvas.connect('realize', self._on_canvas_realize)
-        bus = self.player.get_bus()
-        bus.enable_sync_message_emission()
-        bus.connect('sync-message::element', self._on_sync_element_message)
+        if self._canvas is not None:
+            self._canvas.connect('realize', self._on_canvas_realize)
     
-    def _on_sync_element_message(self, bus, message):
+    def _on_sync_element_message(self, bus, message, playbin):
         if message.get_structure().get_name() == 'prepare-window-handle':
-            self._video_overlay = message.src
-            self._video_overlay.set_window_handle(self._canvas_window_handle)
+            overlay = message.src
+            overlay.set_window_handle(self._canvas_window_handle)
+            self._overlays[playbin] = overlay
+            if playbin is self.player:
+                self._video_overlay = overlay
+            else:
+                # pre-rolled neighbour: keep its frame out of sight until we switch to it
+                overlay.set_render_rectangle(0, 0, 1, 1)
+
+    def _on_bus_message(self, bus, message, playbin):
+        if playbin is not self.player:
+            if message.type == Gst.MessageType.ERROR:
+                self._on_preload_error(message, playbin)
+            return
+        self.tracker.on_message(message)
+        self.scrubber.on_message(message)
+        self.stats.on_message(message, playbin)
+        if message.type == Gst.MessageType.BUFFERING:
+            self._on_buffering(message.parse_buffering())
+        if message.type == Gst.MessageType.ERROR:
+            self._on_error(message)
+        if message.type == Gst.MessageType.STATE_CHANGED and message.src is playbin:
+            old, new, pending = message.parse_state_changed()
+            if new == Gst.State.PLAYING and self._start_called is not None:
+                self.first_frame_latency = time.perf_counter() - self._start_called
+                self._start_called = None
+            if new == Gst.State.PLAYING and self._switch_started is not None:
+                latency = time.perf_counter() - self._switch_started
+                self._switch_started = None
+                self.switch_latencies.append(latency)
+                print('switch latency: %.1f ms' % (latency * 1000))
     
+    def _on_error(self, message):
+        # the active file broke while playing: remember it and move on in the direction
+        # the user was going, unless there is nothing playable left that way. Errors
+        # that aren't the file's fault only pause, they'd hit every file alike.
+        error, debug = message.parse_error()
+        uri = self.player.get_property("uri")
+        print("Error playing %s: %s" % (uri, error.message))
+        if not is_file_error(error):
+            self._switch_started = None
+            self.pause()
+            return
+        if self.metadata is not None:
+            self.metadata.mark_unplayable(uri, error.message, not is_missing_error(error))
+        self._switch_started = None
+        index = self._step(self._direction)
+        if index == self.index:
+            self.pause()
+            self._update_title()
+            return
+        self.index = index
+        # the failed pipeline isn't kept as a preloaded neighbour
+        self._active_index = None
+        self._openVideo()
+
+    def _on_preload_error(self, message, playbin):
+        # a neighbour failed to pre-roll: drop it so switching there doesn't stall,
+        # and if the file is to blame have _step() skip it
+        error, debug = message.parse_error()
+        for index, preloaded in list(self._preloaded.items()):
+            if preloaded is playbin:
+                del self._preloaded[index]
+                self._drop_playbin(playbin)
+                if self.metadata is not None and is_file_error(error):
+                    self.metadata.mark_unplayable(self.files[index], error.message,
+                                                  not is_missing_error(error))
+
+    def _on_playlist_changed(self):
+        # entries were added or removed, so every index may have shifted
+        uri = self.player.get_property("uri")
+        if uri is None:
+            return
+        index = self.files.index_of(uri)
+        if index is not None:
+            self.index = self._active_index = index
+        else:
+            self.index = max(0, min(self.index, len(self.files) - 1))
+            self._active_index = None
+        preloaded, self._preloaded = self._preloaded, {}
+        for playbin in preloaded.values():
+            i = self.files.index_of(playbin.get_property("uri"))
+            if i is None or i in self._preloaded:
+                self._drop_playbin(playbin)
+            else:
+                self._preloaded[i] = playbin
+        self._update_preload()
+        if self.metadata is not None:
+            self.metadata.probe_playlist(self.files, self.index)
+
+    def _on_metadata(self, uri, info):
+        if uri == self.player.get_property("uri"):
+            self._update_title()
+            if self.tracker.duration is None and info.get("duration"):
+                self.tracker.reset(info["duration"])
+
+    def _request_thumbnails(self, uri):
+        if self.thumbnails is None:
+            return
+        if self._sprite is not None:
+            self._sprite.close()
+            self._sprite = None
+        self.thumbnails.request(uri)
+
+    def _on_thumbnails(self, uri, sprite):
+        if uri == self.player.get_property("uri"):
+            if self._sprite is not None:
+                self._sprite.close()
+            self._sprite = sprite
+        else:
+            sprite.close()
+
+    def _on_slider_tooltip(self, slider, x, y, keyboard_mode, tooltip):
+        if self._sprite is None or keyboard_mode:
+            return False
+        trough = slider.get_range_rect()
+        fraction = max(0.0, min(1.0, (x - trough.x) / max(1, trough.width)))
+        position = fraction * (self.tracker.duration or self._sprite.count * self._sprite.interval)
+        tooltip.set_icon(self._sprite.pixbuf(position))
+        tooltip.set_text(format_time(int(position)))
+        return True
+
+    def _request_chapters(self, uri):
+        # chapter and in/out marks all belong to the file that was playing, so they go
+        # whenever the active pipeline gets another uri
+        self.chapters = []
+        self.clip_in = self.clip_out = None
+        self._draw_marks()
+        if self.scenes is not None:
+            self.scenes.request(uri)
+
+    def _on_chapters(self, uri, duration, cuts):
+        if uri != self.player.get_property("uri"):
+            return
+        self.chapters = cuts
+        self._marks_duration = duration
+        self._draw_marks()
+
+    def _draw_marks(self):
+        # scene cuts below the slider, the clip in/out points above it
+        if self.slider is None:
+            return
+        self.slider.clear_marks()
+        duration = self.tracker.duration or self._marks_duration
+        if not duration:
+            return
+        for position in self.chapters:
+            self.slider.add_mark(position * 100 / duration, Gtk.PositionType.BOTTOM, None)
+        for position in (self.clip_in, self.clip_out):
+            if position is not None:
+                self.slider.add_mark(position * 100 / duration, Gtk.PositionType.TOP, None)
+
+    def mark_clip(self, which):
+        # 'in' snaps back to a keyframe, where a copy without re-encoding has to start
+        position = self.current_position()
+        if which == "in":
+            if self.keyframes is not None:
+                position = self.keyframes.before(position)
+            self.clip_in = position
+        else:
+            self.clip_out = position
+        print('clip %s at %s' % (which, format_time(position)))
+        self._draw_marks()
+
+    def export_clip(self):
+        # remux clip_in-clip_out of the file playing next to it, progress on the slider;
+        # the marks are cleared by _begin_file() whenever that file changes
+        uri = self.player.get_property("uri")
+        duration = self.tracker.duration
+        start = self.clip_in or 0
+        stop = self.clip_out if self.clip_out is not None else duration
+        if self.exporter is not None or not (uri or "").startswith("file://") or not stop or stop <= start:
+            print("nothing to export")
+            return
+        source = GLib.filename_from_uri(uri)[0]
+        base, ext = os.path.splitext(source)
+        stamp = lambda ns: format_time(ns).replace(":", "")
+        path = "%s.%s-%s%s" % (base, stamp(start), stamp(stop), ext if ext.lower() in (".mp4", ".mkv") else ".mkv")
+        self.exporter = ClipExporter(uri, start, stop, path)
+        self.exporter.on_progress = self._on_export_progress
+        self.exporter.on_done = lambda error: self._on_export_done(path, error)
+        print('exporting ' + path)
+        self.exporter.run()
+
+    def _on_export_progress(self, fraction):
+        if self.slider is not None and self.tracker.duration:
+            start = self.exporter.start * 100 / self.tracker.duration
+            stop = self.exporter.stop * 100 / self.tracker.duration
+            self.slider.set_show_fill_level(True)
+            self.slider.set_restrict_to_fill_level(False)
+            self.slider.set_fill_level(start + (stop - start) * fraction)
+
+    def _on_export_done(self, path, error):
+        self.exporter = None
+        print('exported ' + path if error is None else "export failed: " + error)
+        # back to the stream's buffered range or none at all
+        self.tracker.reset(self.tracker.duration)
+
+    def _request_waveform(self, uri):
+        self._waveform = None
+        if self.slider is not None:
+            self.slider.queue_draw()
+        if self.waveforms is not None:
+            self.waveforms.request(uri)
+
+    def _on_waveform(self, uri, waveform):
+        if uri == self.player.get_property("uri"):
+            self._waveform = waveform
+            if self.slider is not None:
+                self.slider.queue_draw()
+
+    def _on_slider_draw(self, slider, cr):
+        # peaks light and RMS dark behind the trough, the slider draws over them
+        if self._waveform is None:
+            return False
+        trough = slider.get_range_rect()
+        if trough.width <= 1:
+            return False
+        peak, rms = self._waveform.columns(trough.width)
+        middle = trough.y + trough.height / 2.0
+        half = slider.get_allocated_height() / 2.0
+        for levels, alpha in ((peak, 0.25), (rms, 0.5)):
+            cr.set_source_rgba(0.3, 0.5, 0.8, alpha)
+            for x, level in enumerate(levels):
+                height = min(1.0, float(level)) * half
+                cr.rectangle(trough.x + x, middle - height, 1, 2 * height)
+            cr.fill()
+        return False
+
+    def _request_keyframes(self, uri):
+        self.keyframes = None
+        if self.keyframe_indexer is not None:
+            self.keyframe_indexer.request(uri)
+
+    def _on_keyframes(self, uri, index):
+        if uri == self.player.get_property("uri"):
+            self.keyframes = index
+
+    def plan_seek(self, position):
+        # (position, flags) for a seek the user will watch land
+        if self.keyframes is None:
+            return position, Gst.SeekFlags.FLUSH | Gst.SeekFlags.KEY_UNIT
+        keyframe = self.keyframes.nearest(position)
+        if keyframe is not None and abs(keyframe - position) <= self.snap_tolerance:
+            # starts decoding right at the keyframe, as cheap as a KEY_UNIT seek
+            self.seek_decode_cost = 0
+            return keyframe, Gst.SeekFlags.FLUSH | Gst.SeekFlags.ACCURATE
+        self.seek_decode_cost = position - self.keyframes.before(position)
+        return position, Gst.SeekFlags.FLUSH | Gst.SeekFlags.ACCURATE
+
+    def _frame_duration(self):
+        return self.keyframes.frame_duration if self.keyframes is not None else Gst.SECOND // 25
+
+    def step_frame(self, direction = 1):
+        # from the frame cache if it has the neighbouring frame; otherwise one frame
+        # forward with a step event, back with an accurate seek one frame earlier
+        if self.is_playing:
+            self.toggle_playpause()
+        frame = self._frame_duration()
+        target = self.current_position() + direction * frame
+        if self._show_cached_frame(target, frame // 2):
+            return
+        if direction > 0 and self._cached_position is None:
+            # to the video sink only, stepping the whole playbin would step (and drop)
+            # the audio as well
+            sink = self.video_sink_element() or self.player
+            sink.send_event(Gst.Event.new_step(Gst.Format.BUFFERS, 1, 1.0, True, False))
+            return
+        self.scrubber.seek(target, accurate = True)
+
+    def _show_cached_frame(self, position, tolerance):
+        # put the cached frame near position on the canvas, the pipeline stays where it is
+        if self.frame_cache is None:
+            return False
+        sample = self.frame_cache.lookup(position, tolerance)
+        if sample is None:
+            return False
+        self._cached_position = sample.get_buffer().pts
+        if self._canvas is not None:
+            rgb = GstVideo.video_convert_sample(sample,
+                Gst.Caps.from_string("video/x-raw,format=RGB,pixel-aspect-ratio=1/1"), Gst.SECOND)
+            info = GstVideo.VideoInfo()
+            if rgb is not None and info.from_caps(rgb.get_caps()):
+                buffer = rgb.get_buffer()
+                self._cached_pixbuf = GdkPixbuf.Pixbuf.new_from_bytes(
+                    GLib.Bytes.new(buffer.extract_dup(0, buffer.get_size())),
+                    GdkPixbuf.Colorspace.RGB, False, 8, info.width, info.height, info.stride[0])
+            self._canvas.queue_draw()
+        if self.tracker.duration and self.slider is not None:
+            self.tracker.set_position(self._cached_position)
+        return True
+
+    def _leave_cached_frame(self):
+        # the sink draws again from where the pipeline is
+        if self._cached_position is None:
+            return
+        self._cached_position = None
+        self._cached_pixbuf = None
+        if self._video_overlay is not None:
+            self._video_overlay.expose()
+
+    def _on_canvas_draw(self, canvas, cr):
+        if self._cached_pixbuf is None:
+            return False
+        width, height = canvas.get_allocated_width(), canvas.get_allocated_height()
+        scale = min(width / self._cached_pixbuf.get_width(), height / self._cached_pixbuf.get_height())
+        cr.set_source_rgb(0, 0, 0)
+        cr.paint()
+        cr.translate((width - self._cached_pixbuf.get_width() * scale) / 2,
+                     (height - self._cached_pixbuf.get_height() * scale) / 2)
+        cr.scale(scale, scale)
+        Gdk.cairo_set_source_pixbuf(cr, self._cached_pixbuf, 0, 0)
+        cr.paint()
+        return True
+
+    def jump_chapter(self, direction = 1):
+        # accurate seek to the next cut, or back to the start of this chapter; a
+        # second press within a second of a cut goes on to the one before
+        position = self.current_position()
+        if direction > 0:
+            target = next((cut for cut in self.chapters if cut > position + Gst.SECOND // 2), None)
+            if target is None:
+                return
+        else:
+            target = next((cut for cut in reversed(self.chapters) if cut < position - Gst.SECOND), 0)
+        self.scrubber.seek(target, accurate = True)
+
+    def open_files(self, files, index = 0):
+        # switch to another playlist, e.g. one handed over by a later launch
+        if isinstance(self.files, (Playlist, PlaylistFile)):
+            self.files.close()
+        for playbin in self._preloaded.values():
+            self._drop_playbin(playbin)
+        self._preloaded.clear()
+        self.files = files
+        self.index = index
+        self._active_index = None
+        if isinstance(files, (Playlist, PlaylistFile)):
+            files.on_change = self._on_playlist_changed
+        if self.window is not None:
+            self.window.present()
+        self._openVideo()
+        if self.metadata is not None:
+            self.metadata.probe_playlist(self.files, self.index)
+
+    def _cached_info(self, index):
+        if self.metadata is None:
+            return None
+        return self.metadata.get(self.files[index])
+
+    def _update_title(self, uri = None):
+        if self.window is None:
+            return
+        title = uri or self.player.get_property("uri")
+        info = self.metadata.get(title) if self.metadata is not None else None
+        if info is not None:
+            title += " - " + describe_media(info)
+        self.window.set_title(title)
+
+    def _begin_file(self, uri):
+        # per-file state for uri, about to play in the active pipeline
+        self._update_title(uri)
+        self._request_thumbnails(uri)
+        self._request_chapters(uri)
+        self._request_waveform(uri)
+        self._request_keyframes(uri)
+        self.stats.begin(uri)
+
+    def video_sink_element(self):
+        # the sink actually rendering for the active pipeline
+        if self._video_overlay is not None:
+            return self._video_overlay
+        return self.player.get_property("video-sink")
+
     def _on_canvas_realize(self, canvas):
         self._canvas_window_handle = get_window_handle(canvas)
 
+    def _on_window_state_event(self, window, event):
+        self._iconified = bool(event.new_window_state & Gdk.WindowState.ICONIFIED)
+        self._update_visibility()
+
+    def _on_visibility_notify(self, window, event):
+        self._obscured = event.state == Gdk.VisibilityState.FULLY_OBSCURED
+        self._update_visibility()
+
+    def _on_canvas_size_allocate(self, canvas, allocation):
+        self._zero_sized = allocation.width <= 1 or allocation.height <= 1
+        self._update_visibility()
+        self._schedule_rescale()
+
+    def _update_visibility(self):
+        # nobody can see the video: stop rendering it (audio plays on) until shown again
+        hidden = self._iconified or self._obscured or self._zero_sized
+        if hidden == self.video_hidden:
+            return
+        self.video_hidden = hidden
+        print('video hidden' if hidden else 'video shown')
+        self.tracker.set_visible(not hidden)
+        self._set_video_enabled(self.player, not hidden)
+
+    def _set_video_enabled(self, playbin, enabled):
+        # playbin reconfigures its sinks on the fly when flags change, the audio
+        # branch isn't flushed so sound continues without a gap
+        flags = int(playbin.get_property("flags"))
+        if enabled:
+            flags |= self.PLAY_FLAG_VIDEO
+        else:
+            flags &= ~self.PLAY_FLAG_VIDEO
+        playbin.set_property("flags", flags)
+        overlay = self._overlays.get(playbin)
+        if enabled and overlay is not None:
+            overlay.expose()
+
+    def _apply_sink_probe(self):
+        # A cached result is used right away. Otherwise the probe runs on a thread while
+        # the first video plays with the defaults, and what it finds applies to the
+        # pipelines built after it is done.
+        best = self.sink_probe.cached()
+        if best is not None:
+            self._use_sink_probe(best, True)
+            return
+        window = None
+        if self._canvas is not None:
+            # an unmapped window for the probed sinks to draw into, not our canvas
+            window = Gtk.Window(type = Gtk.WindowType.POPUP)
+            window.set_default_size(1, 1)
+            window.realize()
+        handle = get_window_handle(window) if window is not None else None
+
+        def probe():
+            best = self.sink_probe.result(handle)
+            GLib.idle_add(self._on_sink_probe, best, window)
+
+        threading.Thread(target = probe, name = "sink-probe", daemon = True).start()
+
+    def _on_sink_probe(self, best, window):
+        if window is not None:
+            window.destroy()
+        self._use_sink_probe(best, False)
+        return False
+
+    def _use_sink_probe(self, best, replace_sink):
+        # the decoder thread count is read in element-setup, so decoders created from
+        # now on get it; the sink of a pipeline can only change before it starts
+        if self.decoder_threads is None:
+            self.decoder_threads = best.get("max-threads")
+        if self.video_sink is None and best.get("video-sink"):
+            self.video_sink = best["video-sink"]
+            if replace_sink:
+                self.player.set_property("video-sink", Gst.ElementFactory.make(self.video_sink))
+
     def start(self):
-        self.player.set_property('uri',  self.files[self.index])
+        if self.sink_probe is not None and (self.video_sink is None or self.decoder_threads is None):
+            self._apply_sink_probe()
+        self._start_called = time.perf_counter()
+        uri = self._file(self.index)
+        self._load(self.player, uri)
+        self._active_index = self.index
+        self._buffering = False
+        self.tracker.reset()
+        self._begin_file(uri)
         self.play()
+        self._update_preload()
+        if self.metadata is not None:
+            self.metadata.probe_playlist(self.files, self.index)
     
     def toggle_fullscreen(self):
         if self.is_fullscreen:
@@ -155,6 +2896,7 @@ class VideoPlayer:
             self.builder.get_object("box2").hide()
             self.builder.get_object("box3").hide()
             self.is_fullscreen = True   
+        self._schedule_rescale()
     
     def toggle_playpause(self):
         if self.is_playing:
@@ -165,26 +2907,109 @@ class VideoPlayer:
             self.is_playing = True
 
     def _openVideo(self):
-        self.window.set_title( self.files[self.index] )
-        self.player.set_state(Gst.State.NULL)
-        self.player.set_property("uri", self.files[self.index] )
+        self._begin_file(self.files[self.index])
+        self._switch_started = time.perf_counter()
+        self._buffering = False
+        if self.preload:
+            self._switch_pipeline(self.index)
+        else:
+            self.player.set_state(Gst.State.NULL)
+            self._load(self.player, self._file(self.index))
         #self.player.set_state(Gst.State.PLAYING)
+        self.rate = 1.0
+        info = self._cached_info(self.index)
+        self.tracker.reset(info.get("duration") if info else None)
+        self.scrubber.cancel()
+        self._leave_cached_frame()
+        if self.frame_cache is not None:
+            self.frame_cache.clear()
         self.play()
+        self._update_preload()
+
+    def _switch_pipeline(self, index):
+        # hand the canvas to the pipeline already pre-rolled on files[index]
+        old = self.player
+        if index == self._active_index:
+            old.seek_simple(Gst.Format.TIME, Gst.SeekFlags.FLUSH | Gst.SeekFlags.KEY_UNIT, 0)
+            return
+        playbin = self._preloaded.pop(index, None)
+        if playbin is None:
+            # neighbour not pre-rolled (yet), fall back to a cold start
+            playbin = self._make_playbin()
+            self._load(playbin, self._file(index))
+
+        old_overlay = self._overlays.get(old)
+        if old_overlay is not None:
+            old_overlay.set_render_rectangle(0, 0, 1, 1)
+        if self._active_index is None:
+            # it played a file that is gone from the playlist or failed
+            self._drop_playbin(old)
+        else:
+            old.set_state(Gst.State.PAUSED)
+            old.seek_simple(Gst.Format.TIME, Gst.SeekFlags.FLUSH | Gst.SeekFlags.KEY_UNIT, 0)
+            self._preloaded[self._active_index] = old
+        if self.video_hidden:
+            # the hidden state belongs to whichever pipeline is active
+            self._set_video_enabled(old, True)
+            self._set_video_enabled(playbin, False)
+
+        self.player = playbin
+        self._active_index = index
+        if self.frame_tap is not None:
+            self.frame_tap.active = playbin
+        if self.frame_cache is not None:
+            self.frame_cache.active = playbin
+        self._video_overlay = self._overlays.get(playbin)
+        if self._video_overlay is not None:
+            self._video_overlay.set_render_rectangle(0, 0, -1, -1)
+            self._video_overlay.expose()
+
+    def _update_preload(self):
+        wanted = set()
+        for step in range(1, self.preload + 1):
+            for i in (self.index - step, self.index + step):
+                # streams aren't pre-rolled: with download buffering each would fetch
+                # the whole file alongside the one being watched
+                if 0 <= i < len(self.files) and i != self._active_index and not is_stream(self.files[i]):
+                    info = self._cached_info(i)
+                    if info is None or info["playable"]:
+                        wanted.add(i)
+        for i in list(self._preloaded):
+            if i not in wanted:
+                self._drop_playbin(self._preloaded.pop(i))
+        for i in sorted(wanted):
+            if self.metadata is not None:
+                self.metadata.request(self.files[i])
+            if i not in self._preloaded:
+                playbin = self._make_playbin()
+                self._load(playbin, self._file(i))
+                playbin.set_state(Gst.State.PAUSED)
+                self._preloaded[i] = playbin
+
+    def _step(self, step):
+        # nearest index in direction step not known to be unplayable; at either end
+        # of the playlist we stay where we are, which restarts the current video
+        index = self.index + step
+        while 0 <= index < len(self.files):
+            info = self._cached_info(index)
+            if info is None or info["playable"]:
+                return index
+            print('skipping unplayable ' + self.files[index])
+            index += step
+        return self.index
 
     def previousVideo(self):
         print('previousvideo')
-        self.index -= 1
-        if self.index <= -1:
-            self.index = 0
+        self._direction = -1
+        self.index = self._step(-1)
             
         print ( self.files[self.index] )
         self._openVideo()
         
     def nextVideo(self):
         print('nextvideo')
-        self.index += 1
-        if self.index >= len(self.files):
-            self.index = len(self.files) - 1
+        self._direction = 1
+        self.index = self._step(1)
             
         print ( self.files[self.index] )
         self._openVideo()
@@ -197,6 +3022,28 @@ class VideoPlayer:
         elif key == 'Right':
             self.nextVideo()
             return True
+        elif key == 'bracketright':
+            self.change_rate(1)
+        elif key == 'bracketleft':
+            self.change_rate(-1)
+        elif key == 'backslash':
+            self.set_rate(1.0)
+        elif key == 'i':
+            self.mark_clip("in")
+        elif key == 'o':
+            self.mark_clip("out")
+        elif key == 'e':
+            self.export_clip()
+        elif key == 'period':
+            self.step_frame(1)
+        elif key == 'comma':
+            self.step_frame(-1)
+        elif key == 'Page_Down':
+            self.jump_chapter(1)
+            return True
+        elif key == 'Page_Up':
+            self.jump_chapter(-1)
+            return True
         elif key == 'f' or key == 'F11':
             self.toggle_fullscreen()
         elif key == 'space':
@@ -205,59 +3052,466 @@ class VideoPlayer:
             Gtk.main_quit()   
 
     def play(self):
+        if self._cached_position is not None:
+            # carry on from the cached frame on screen, not from where the pipeline stopped
+            self.scrubber.seek(self._cached_position, accurate = True)
         self.is_playing = True
-        self.player.set_state(Gst.State.PLAYING)
-        #starting up a timer to check on the current playback value
-        GLib.timeout_add(1000, self.update_slider)
+        if self.frame_cache is not None:
+            self.frame_cache.paused = False
+        # while buffering, _on_buffering() starts playback once the buffer is full
+        self.player.set_state(Gst.State.PAUSED if self._buffering else Gst.State.PLAYING)
+        # the tracker runs at most one slider timer however often we get here
+        self.tracker.start()
         
     def pause(self):
         self.is_playing = False
+        if self.frame_cache is not None:
+            self.frame_cache.paused = True
         self.player.set_state(Gst.State.PAUSED)
+        self.tracker.stop()
         
     def current_position(self):
+        if self._cached_position is not None:
+            return self._cached_position
         status,position = self.player.query_position(Gst.Format.TIME)
         return position
 
+    def seek_to(self, position, flags):
+        # flushing seek on the active pipeline that keeps the current playback rate
+        self._leave_cached_frame()
+        if self.rate == 1.0:
+            return self.player.seek_simple(Gst.Format.TIME, flags, position)
+        if abs(self.rate) > 2 or self.rate < 0:
+            # trick mode: decode keyframes only and leave the audio out
+            flags |= (Gst.SeekFlags.TRICKMODE | Gst.SeekFlags.TRICKMODE_KEY_UNITS |
+                      Gst.SeekFlags.TRICKMODE_NO_AUDIO)
+        if self.rate > 0:
+            return self.player.seek(self.rate, Gst.Format.TIME, flags,
+                                    Gst.SeekType.SET, position, Gst.SeekType.SET, -1)
+        # playing backwards runs from position down to the start
+        return self.player.seek(self.rate, Gst.Format.TIME, flags,
+                                Gst.SeekType.SET, 0, Gst.SeekType.SET, position)
+
+    def set_rate(self, rate):
+        if rate == self.rate:
+            return
+        print('rate %gx' % rate)
+        self.rate = rate
+        self.scrubber.seek(self.current_position(), accurate = 0 < rate <= 2)
+        if self.is_playing:
+            # the slider moves faster or slower now, retune its timer
+            self.tracker.start()
+
+    def change_rate(self, step):
+        nearest = min(range(len(self.rates)), key = lambda i: abs(self.rates[i] - self.rate))
+        self.set_rate(self.rates[max(0, min(len(self.rates) - 1, nearest + step))])
+
     def skip_time(self,direction=1):
         #skip 20 seconds on forward/backward button
-        player.player.seek_simple(Gst.Format.TIME,  Gst.SeekFlags.FLUSH | Gst.SeekFlags.KEY_UNIT, 
-            self.current_position() + float(20) * Gst.SECOND * direction )
-
-    def update_slider(self):
-        if not self.is_playing:
-            return False # cancel timeout
-        else:
-            success, self.duration = self.player.query_duration(Gst.Format.TIME)
-            # adjust duration and position relative to absolute scale of 100
-            self.mult = 100 /  (1 if (self.duration / Gst.SECOND) == 0 else (self.duration / Gst.SECOND))
-            
-            if not success:
-                raise GenericException("Couldn't fetch duration")
-            # fetching the position, in nanosecs
-            success, position = self.player.query_position(Gst.Format.TIME)
-            if not success:
-                raise GenericException("Couldn't fetch current position to update slider")
-            
-            # block seek handler so we don't seek when we set_value()
-            self.slider.handler_block(self.slider_handler_id)
-            self.slider.set_value(float(position) / Gst.SECOND * self.mult)
-            self.slider.handler_unblock(self.slider_handler_id)
-        return True # continue calling every x milliseconds
+        self.scrubber.seek(self.current_position() + 20 * Gst.SECOND * direction)
 
     def on_slider_seek(self, slider):
-        success, self.duration = self.player.query_duration(Gst.Format.TIME)
-        seek_time_secs = slider.get_value()
-        self.player.seek_simple(Gst.Format.TIME, Gst.SeekFlags.FLUSH | Gst.SeekFlags.KEY_UNIT, 
-            self.duration * (seek_time_secs/100)  )
-        #self.player.seek(1.0, Gst.Format.TIME, (Gst.SeekFlags.FLUSH | Gst.SeekFlags.ACCURATE),
-        #    Gst.SeekType.SET, self.duration * (seek_time_secs/100), Gst.SeekType.NONE, -1)
+        if self.tracker.duration:
+            position = self.tracker.duration * (slider.get_value() / 100)
+            # paused, small moves are shown from the frame cache without seeking
+            if not self.is_playing and self._show_cached_frame(position, self._frame_duration()):
+                return
+            self.scrubber.seek(position)
+
+    def _on_slider_press(self, slider, event):
+        # while dragging only cheap keyframe seeks are issued
+        self.scrubber.dragging = True
+        return False
+
+    def _on_slider_release(self, slider, event):
+        self.scrubber.dragging = False
+        if self.tracker.duration and self._cached_position is None:
+            self.scrubber.seek(self.tracker.duration * (slider.get_value() / 100), accurate = True)
+        return False
     
+    def close(self):
+        # release every pipeline, the player can't be used afterwards
+        self.tracker.stop()
+        self.scrubber.cancel()
+        for playbin in self._preloaded.values():
+            self._drop_playbin(playbin)
+        self._preloaded.clear()
+        self._drop_playbin(self.player)
+        if self.metadata is not None:
+            self.metadata.close()
+        if self._sprite is not None:
+            self._sprite.close()
+            self._sprite = None
+        if self.frame_tap is not None:
+            self.frame_tap.close()
+        for worker in (self.thumbnails, self.scenes, self.waveforms, self.keyframe_indexer):
+            if worker is not None:
+                worker.close()
+        if self.exporter is not None:
+            self.exporter.cancel()
+
     def clear_playbin(self):
         try:
             self.player.set_state(Gst.State.NULL)
         except:
             pass
 
+class MosaicTile:
+    # One branch of the mosaic: uridecodebin ! videoconvert ! videoscale ! capsfilter ! queue,
+    # linked to its own compositor pad. Pausing blocks the queue's src pad; the
+    # compositor keeps showing the last frame and the branch stops decoding.
+
+    def __init__(self, mosaic, uri, compositor, xpos, ypos, width, height):
+        self.mosaic = mosaic
+        self.uri = uri
+        self.paused_at = None     # running time when paused
+        self._block_id = None
+        pipeline = mosaic.pipeline
+        self.decode = Gst.ElementFactory.make("uridecodebin")
+        self.decode.set_property("uri", uri)
+        self.decode.set_property("caps", Gst.Caps.from_string("video/x-raw"))
+        self.decode.set_property("expose-all-streams", False)
+        self.convert = Gst.ElementFactory.make("videoconvert")
+        scale = Gst.ElementFactory.make("videoscale")
+        capsfilter = Gst.ElementFactory.make("capsfilter")
+        capsfilter.set_property("caps", Gst.Caps.from_string(
+            "video/x-raw,width=%d,height=%d,pixel-aspect-ratio=1/1" % (width, height)))
+        self.queue = Gst.ElementFactory.make("queue")
+        for element in (self.decode, self.convert, scale, capsfilter, self.queue):
+            pipeline.add(element)
+        self.convert.link(scale)
+        scale.link(capsfilter)
+        capsfilter.link(self.queue)
+        self.pad = self.queue.get_static_pad("src")
+        sinkpad = compositor.get_request_pad("sink_%u")
+        sinkpad.set_property("xpos", xpos)
+        sinkpad.set_property("ypos", ypos)
+        self.pad.link(sinkpad)
+        self.decode.connect("pad-added", self._on_pad_added)
+
+    def _on_pad_added(self, decode, pad):
+        sinkpad = self.convert.get_static_pad("sink")
+        if not sinkpad.is_linked() and pad.query_caps(None).to_string().startswith("video/x-raw"):
+            pad.link(sinkpad)
+
+    def position(self):
+        success, position = self.pad.query_position(Gst.Format.TIME)
+        return position if success else 0
+
+    def seek(self, position):
+        # flushes only this branch; the new segment starts at running time 0,
+        # so shift it to line up with the rest of the mosaic
+        event = Gst.Event.new_seek(1.0, Gst.Format.TIME, Gst.SeekFlags.FLUSH | Gst.SeekFlags.KEY_UNIT,
+                                   Gst.SeekType.SET, max(0, int(position)), Gst.SeekType.NONE, -1)
+        if self.pad.send_event(event):
+            self.pad.set_offset(self.paused_at if self.paused_at is not None else self.mosaic.running_time())
+
+    def pause(self):
+        if self._block_id is None:
+            self.paused_at = self.mosaic.running_time()
+            self._block_id = self.pad.add_probe(Gst.PadProbeType.BLOCK_DOWNSTREAM, lambda *_: Gst.PadProbeReturn.OK)
+
+    def resume(self):
+        if self._block_id is not None:
+            # the frames held back are now late by the time spent paused
+            self.pad.set_offset(self.pad.get_offset() + self.mosaic.running_time() - self.paused_at)
+            self.pad.remove_probe(self._block_id)
+            self._block_id = None
+            self.paused_at = None
+
+    @property
+    def paused(self):
+        return self._block_id is not None
+
+
+class MosaicPlayer:
+    # Plays several files of the playlist side by side with one pipeline: a branch per
+    # tile feeds a single compositor that draws into the play_here canvas. Each branch
+    # decodes and scales on its own streaming thread, spread over the cores, and all
+    # share the pipeline clock. A live black background keeps the compositor running
+    # while single tiles are paused or seeking. Mosaics are silent.
+
+    max_tiles = 16
+    framerate = 25
+    is_fullscreen = False
+
+    def __init__(self, window, canvas, files, index = 0, count = 4, video_sink = None):
+        self.window = window
+        self._canvas = canvas
+        self.files = files
+        self.first = files[index]
+        self.count = max(1, min(count, self.max_tiles))
+        self.uris = []
+        self.video_sink = video_sink
+        self.selected = None     # tile index the keys act on, None for all tiles
+        self.tiles = []
+        self.pipeline = None
+        self._canvas_window_handle = None
+        canvas.connect("realize", self._on_canvas_realize)
+
+    def _on_canvas_realize(self, canvas):
+        self._canvas_window_handle = get_window_handle(canvas)
+
+    def _build(self):
+        n = len(self.uris)
+        cols = int(math.ceil(math.sqrt(n)))
+        rows = int(math.ceil(n / cols))
+        scale = self._canvas.get_scale_factor()
+        width = max(320, self._canvas.get_allocated_width() * scale)
+        height = max(180, self._canvas.get_allocated_height() * scale)
+        tile_width, tile_height = width // cols & ~1, height // rows & ~1
+        width, height = tile_width * cols, tile_height * rows
+
+        self.pipeline = Gst.Pipeline.new("mosaic")
+        # split the cores between the tiles instead of every decoder starting one per core
+        threads = max(1, (os.cpu_count() or 1) // n)
+        self.pipeline.connect("deep-element-added",
+            lambda pipeline, bin, element: set_decoder_threads(element, threads))
+        background = Gst.parse_bin_from_description(
+            "videotestsrc is-live=true pattern=black ! video/x-raw,width=%d,height=%d,framerate=%d/1"
+            % (width, height, self.framerate), True)
+        compositor = Gst.ElementFactory.make("compositor")
+        convert = Gst.ElementFactory.make("videoconvert")
+        sink = Gst.ElementFactory.make(self.video_sink or "autovideosink")
+        for element in (background, compositor, convert, sink):
+            self.pipeline.add(element)
+        background_pad = compositor.get_request_pad("sink_%u")
+        background_pad.set_property("zorder", 0)
+        background.get_static_pad("src").link(background_pad)
+        compositor.link(convert)
+        convert.link(sink)
+
+        for i, uri in enumerate(self.uris):
+            self.tiles.append(MosaicTile(self, uri, compositor, i % cols * tile_width,
+                                         i // cols * tile_height, tile_width, tile_height))
+
+        bus = self.pipeline.get_bus()
+        bus.enable_sync_message_emission()
+        bus.connect('sync-message::element', self._on_sync_element_message)
+        bus.add_signal_watch()
+        bus.connect('message::error', self._on_error)
+
+    def _on_sync_element_message(self, bus, message):
+        if message.get_structure().get_name() == 'prepare-window-handle':
+            message.src.set_window_handle(self._canvas_window_handle)
+
+    def _on_error(self, bus, message):
+        error, debug = message.parse_error()
+        print("mosaic: %s" % error.message)
+
+    def running_time(self):
+        clock = self.pipeline.get_clock()
+        if clock is None:
+            return 0
+        return clock.get_time() - self.pipeline.get_base_time()
+
+    def start(self):
+        # the tiles are the files after the first one, so a playlist still being
+        # listed in the background has to be complete first
+        if self.pipeline is not None:
+            return
+        if not getattr(self.files, "loaded", True):
+            self.files.on_change = self.start
+            return
+        index = self.files.index_of(self.first) if hasattr(self.files, "index_of") else None
+        if index is None:
+            index = self.files.index(self.first) if isinstance(self.files, list) else 0
+        self.uris = [self.files[i] for i in range(index, min(len(self.files), index + self.count))]
+        self._build()
+        self.window.set_title("Mosaic: %d videos" % len(self.tiles))
+        self.pipeline.set_state(Gst.State.PLAYING)
+
+    def _targets(self):
+        if self.selected is None:
+            return self.tiles
+        return [self.tiles[self.selected]]
+
+    def toggle_playpause(self):
+        targets = self._targets()
+        if any(not tile.paused for tile in targets):
+            for tile in targets:
+                tile.pause()
+        else:
+            for tile in targets:
+                tile.resume()
+
+    def skip_time(self, direction = 1):
+        for tile in self._targets():
+            tile.seek(tile.position() + 20 * Gst.SECOND * direction)
+
+    def select(self, number):
+        # 1-9 pick a tile, 0 goes back to acting on all of them
+        self.selected = number - 1 if 0 < number <= len(self.tiles) else None
+        print('selected tile %s' % (self.selected + 1 if self.selected is not None else 'all'))
+
+    def cycle(self, step = 1):
+        # Tab/Shift+Tab go through all, tile 1, 2, ... so tiles past 9 can be picked too
+        number = (self.selected + 1 if self.selected is not None else 0) + step
+        self.select(number % (len(self.tiles) + 1))
+
+    def toggle_fullscreen(self):
+        if self.is_fullscreen:
+            self.window.unfullscreen()
+        else:
+            self.window.fullscreen()
+        self.is_fullscreen = not self.is_fullscreen
+
+    def on_key_press(self, widget, event):
+        key = Gdk.keyval_name(event.keyval)
+        if key == 'Left':
+            self.skip_time(-1)
+            return True
+        elif key == 'Right':
+            self.skip_time()
+            return True
+        elif key == 'Tab':
+            self.cycle()
+            return True
+        elif key == 'ISO_Left_Tab':
+            self.cycle(-1)
+            return True
+        elif key.isdigit():
+            self.select(int(key))
+        elif key == 'f' or key == 'F11':
+            self.toggle_fullscreen()
+        elif key == 'space':
+            self.toggle_playpause()
+        elif key == 'Escape':
+            Gtk.main_quit()
+
+    def close(self):
+        if self.pipeline is not None:
+            self.pipeline.set_state(Gst.State.NULL)
+            self.pipeline.get_bus().remove_signal_watch()
+
+
+class ClipExporter:
+    # Copies the start-stop range of a local file into a new MP4 or Matroska file
+    # without decoding: filesrc ! parsebin feeds every stream the muxer accepts into
+    # mp4mux or matroskamux ! filesink. The parsed pads stay blocked until parsebin has
+    # exposed them all; then one keyframe-snapping seek with a stop position goes to the
+    # demuxer and the data runs through at disk speed. Others are dropped in fakesinks.
+
+    blocksize = 1024 * 1024
+    interval = 200   # ms between progress reports
+
+    def __init__(self, uri, start, stop, path):
+        self.uri = uri
+        self.start = start
+        self.stop = stop
+        self.path = path
+        self.on_progress = None   # called with the fraction done
+        self.on_done = None       # called with None or the error message
+        self._pads = []
+        self._probes = []
+        self._timer_id = None
+        muxer = "mp4mux" if path.lower().endswith((".mp4", ".m4v", ".mov")) else "matroskamux"
+        self.pipeline = Gst.parse_launch(
+            "filesrc name=source blocksize=%d ! parsebin name=parse %s name=mux ! filesink name=sink"
+            % (self.blocksize, muxer))
+        self.pipeline.get_by_name("source").set_property("location", GLib.filename_from_uri(uri)[0])
+        self.pipeline.get_by_name("sink").set_property("location", path + ".part")
+        self.muxer = self.pipeline.get_by_name("mux")
+        parse = self.pipeline.get_by_name("parse")
+        parse.connect("pad-added", self._on_pad_added)
+        parse.connect("no-more-pads", lambda parse: GLib.idle_add(self._seek))
+        bus = self.pipeline.get_bus()
+        bus.add_signal_watch()
+        bus.connect("message", self._on_message)
+
+    def run(self):
+        self.pipeline.set_state(Gst.State.PLAYING)
+        self._timer_id = GLib.timeout_add(self.interval, self._report)
+
+    def _on_pad_added(self, parse, pad):
+        # streaming thread
+        caps = pad.get_current_caps() or pad.query_caps(None)
+        target = self.muxer.get_compatible_pad(pad, caps)
+        if target is None:
+            print("export: leaving out %s" % caps.to_string().split(",")[0])
+            fakesink = Gst.ElementFactory.make("fakesink")
+            fakesink.set_property("async", False)
+            self.pipeline.add(fakesink)
+            fakesink.sync_state_with_parent()
+            target = fakesink.get_static_pad("sink")
+        self._probes.append((pad, pad.add_probe(Gst.PadProbeType.BLOCK_DOWNSTREAM,
+                                                lambda *_: Gst.PadProbeReturn.OK)))
+        self._pads.append(pad)
+        pad.link(target)
+
+    def _seek(self):
+        # main loop; the seek travels upstream to the demuxer, not through the muxer
+        event = Gst.Event.new_seek(1.0, Gst.Format.TIME,
+                                   Gst.SeekFlags.FLUSH | Gst.SeekFlags.KEY_UNIT | Gst.SeekFlags.SNAP_BEFORE,
+                                   Gst.SeekType.SET, self.start, Gst.SeekType.SET, self.stop)
+        if not self._pads or not self._pads[0].send_event(event):
+            self._finish("couldn't seek to the start of the clip")
+            return False
+        for pad, probe in self._probes:
+            pad.remove_probe(probe)
+        self._probes = []
+        return False
+
+    def _report(self):
+        if self.on_progress is not None and self._pads:
+            success, position = self._pads[0].query_position(Gst.Format.TIME)
+            if success and self.stop > self.start:
+                self.on_progress(max(0.0, min(1.0, (position - self.start) / (self.stop - self.start))))
+        return True
+
+    def _on_message(self, bus, message):
+        if message.type == Gst.MessageType.EOS:
+            self._finish(None)
+        elif message.type == Gst.MessageType.ERROR:
+            self._finish(message.parse_error()[0].message)
+
+    def _finish(self, error):
+        if self._timer_id is None:
+            return
+        GLib.source_remove(self._timer_id)
+        self._timer_id = None
+        self.pipeline.set_state(Gst.State.NULL)
+        self.pipeline.get_bus().remove_signal_watch()
+        if error is None:
+            os.replace(self.path + ".part", self.path)
+        elif os.path.exists(self.path + ".part"):
+            os.unlink(self.path + ".part")
+        if self.on_done is not None:
+            self.on_done(error)
+
+    def cancel(self):
+        self._finish("cancelled")
+
+
+def make_test_clip(path, seconds = 10, width = 640, height = 360, fps = 25):
+    # Encode a videotestsrc/audiotestsrc clip to path (.mkv) with the first encoder
+    # available, so benchmarks need neither network nor sample media.
+    encoders = (("x264enc", "x264enc key-int-max=%d speed-preset=ultrafast" % (fps * 2)),
+                ("vp8enc", "vp8enc keyframe-max-dist=%d deadline=1" % (fps * 2)),
+                ("jpegenc", "jpegenc"))
+    for factory, encoder in encoders:
+        if Gst.ElementFactory.find(factory) is not None:
+            break
+    else:
+        raise GenericException("No video encoder available to make test clips")
+
+    frames = seconds * fps
+    pipeline = Gst.parse_launch(
+        "videotestsrc num-buffers=%d pattern=ball "
+        "! video/x-raw,width=%d,height=%d,framerate=%d/1 ! videoconvert ! %s ! queue "
+        "! matroskamux name=mux ! filesink location=\"%s\" "
+        "audiotestsrc num-buffers=%d samplesperbuffer=%d wave=ticks "
+        "! audio/x-raw,format=S16LE,rate=48000,channels=2 ! queue ! mux."
+        % (frames, width, height, fps, encoder, path, frames, 48000 // fps))
+    pipeline.set_state(Gst.State.PLAYING)
+    message = pipeline.get_bus().timed_pop_filtered(Gst.CLOCK_TIME_NONE,
+        Gst.MessageType.EOS | Gst.MessageType.ERROR)
+    pipeline.set_state(Gst.State.NULL)
+    if message.type == Gst.MessageType.ERROR:
+        raise GenericException("Couldn't make test clip: %s" % message.parse_error()[0].message)
+    return path
+
+
 class Glade_file:
     gladestring = """
 <?xml version="1.0" encoding="UTF-8"?>
@@ -444,33 +3698,68 @@ class Glade_file:
 
 if __name__ == "__main__":
 
-    if len(sys.argv) > 1:
+    if args.files:
 
-        ext = (".mp4",".mkv")
-        videos = []
-        directory = os.path.dirname(   os.path.abspath(sys.argv[1])   )
-        print ('directory' + directory )
-        print ( 'file:///' + os.path.abspath(os.path.join(directory, sys.argv[1])) )
-        videos.append ( 'file:///' + os.path.abspath(os.path.join(directory, sys.argv[1])) )
-        
-        files = sorted(os.listdir(directory), reverse = True)
-        for file in files:
-            if file.lower().endswith(ext):
-                videos.append('file:///' + os.path.abspath(os.path.join(directory, file)))
-            
-        print ( 'length of videos:' + str(len(videos)) )
-        for v in videos:
-            print (v)
+        videos, index = open_playlist(args.files, args.ext.split(","), args.sort, args.reverse)
         
         builder = Gtk.Builder()
         builder.add_from_string(Glade_file().get_string())       
         builder.connect_signals(Handler())
         window = builder.get_object("window")
         canvas = builder.get_object("play_here")
-        
-        player = VideoPlayer(builder, window, canvas, videos)
+
+        if args.mosaic:
+            mosaic = MosaicPlayer(window, canvas, videos, index, args.mosaic, video_sink = args.video_sink)
+            window.connect("key-press-event", mosaic.on_key_press)
+            canvas.connect('realize', lambda *_: mosaic.start())
+            window.show_all()
+            # the toolbar drives a single VideoPlayer, the mosaic is run from the keyboard
+            builder.get_object("box2").hide()
+            builder.get_object("box3").hide()
+            Gtk.main()
+            mosaic.close()
+            sys.exit(0)
+
+        metadata = MetadataService(args.probe_workers) if args.probe_workers > 0 else None
+        if args.retry_unplayable and metadata is not None:
+            print("%d unplayable files will be checked again" % metadata.forget_unplayable())
+        thumbnails = ThumbnailExtractor() if args.thumbnails else None
+        sink_probe = SinkProbe() if args.probe else None
+        scenes = SceneDetector() if args.chapters and numpy is not None else None
+        waveforms = WaveformService() if args.waveform and numpy is not None else None
+        keyframes = KeyframeIndexer() if args.keyframes else None
+        frame_cache = FrameCache(args.frame_cache) if args.frame_cache > 0 else None
+        frame_tap = None
+        if args.detect_black:
+            frame_tap = FrameTap()
+            frame_tap.add_plugin(BlackFrameDetector())
+        if args.reprobe and sink_probe is not None and os.path.exists(sink_probe.path):
+            os.unlink(sink_probe.path)
+        player = VideoPlayer(builder, window, canvas, videos, index,
+                             preload = args.preload, metadata = metadata, thumbnails = thumbnails,
+                             video_sink = args.video_sink, decoder_threads = args.decoder_threads,
+                             sink_probe = sink_probe, downscale = args.downscale,
+                             ring_buffer_size = args.ring_buffer * 1024 * 1024,
+                             buffer_size = args.buffer_size * 1024 if args.buffer_size else -1,
+                             buffer_duration = int(args.buffer_duration * Gst.SECOND) if args.buffer_duration else -1,
+                             frame_tap = frame_tap, scenes = scenes, waveforms = waveforms,
+                             keyframes = keyframes, frame_cache = frame_cache)
+        if args.stats_log or args.stats_port:
+            player.stats.interval = args.stats_interval
+            player.stats.log_path = args.stats_log
+            player.stats.start_reporting()
+        metrics = MetricsServer(player.stats, args.stats_port) if args.stats_port else None
+        server = None
+        if not args.new_instance and hasattr(socket, "AF_UNIX"):
+            # later launches hand their files to us, see hand_off()
+            server = InstanceServer(lambda files: player.open_files(
+                *open_playlist(files, args.ext.split(","), args.sort, args.reverse)))
         window.connect("key-press-event", player.on_key_press)
         canvas.connect('realize', lambda *_: player.start())
         window.show_all()
         Gtk.main()
+        if server is not None:
+            server.close()
+        if metrics is not None:
+            metrics.close()
         
@@ -0,0 +1,378 @@
+#!/usr/bin/python3
+#
+# Copyright 2019 Stan S
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Headless benchmark for pyVideoPlayer: drives the real VideoPlayer with fake sinks
+# over locally generated test clips and prints the results as JSON.
+
+import os
+import sys
+import time
+import json
+import argparse
+import resource
+import tempfile
+import threading
+import statistics
+import http.server
+
+started = time.perf_counter()
+from pyVideoPlayer import Gst, GLib, VideoPlayer, GenericException, make_test_clip
+from pyVideoPlayer import ThumbnailExtractor, SpriteSheet, FrameTap, SceneDetector
+from pyVideoPlayer import WaveformService, FrameCache
+import_time = time.perf_counter() - started
+
+
+def wait_for(predicate, timeout = 30):
+    # spin the default main context (bus watches, timers) until predicate() holds
+    context = GLib.MainContext.default()
+    deadline = time.perf_counter() + timeout
+    while not predicate():
+        if time.perf_counter() > deadline:
+            raise GenericException("Timed out waiting for the player")
+        if not context.iteration(False):
+            time.sleep(0.001)
+
+
+def rss_bytes():
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        # ru_maxrss is the peak, in kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def summary(values):
+    if not values:
+        return None
+    values = sorted(values)
+    return {
+        "n": len(values),
+        "min_ms": values[0] * 1000,
+        "median_ms": statistics.median(values) * 1000,
+        "mean_ms": statistics.mean(values) * 1000,
+        "p95_ms": values[min(len(values) - 1, int(len(values) * 0.95))] * 1000,
+        "max_ms": values[-1] * 1000,
+    }
+
+
+def make_fixtures(directory, count, seconds, width, height):
+    paths = []
+    for i in range(count):
+        path = os.path.join(directory, "bench%02d.mkv" % i)
+        if not os.path.exists(path):
+            make_test_clip(path, seconds, width, height)
+        paths.append(path)
+    return [Gst.filename_to_uri(path) for path in paths]
+
+
+class RangeRequestHandler(http.server.SimpleHTTPRequestHandler):
+    # SimpleHTTPRequestHandler plus single byte-range requests, sending at most
+    # bandwidth bytes per second (0 = unthrottled) like a slow media server
+
+    bandwidth = 0
+    chunk = 64 * 1024
+
+    def send_head(self):
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return None
+        size = os.path.getsize(path)
+        start, end = 0, size - 1
+        header = self.headers.get("Range", "")
+        if header.startswith("bytes="):
+            first, _, last = header[6:].split(",")[0].partition("-")
+            if first:
+                start, end = int(first), int(last) if last else size - 1
+            else:
+                start = max(0, size - int(last))
+            end = min(end, size - 1)
+            if start > end:
+                self.send_response(416)
+                self.send_header("Content-Range", "bytes */%d" % size)
+                self.end_headers()
+                return None
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes %d-%d/%d" % (start, end, size))
+        else:
+            self.send_response(200)
+        self.send_header("Content-Type", self.guess_type(path))
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Accept-Ranges", "bytes")
+        self.end_headers()
+        f = open(path, "rb")
+        f.seek(start)
+        self._remaining = end - start + 1
+        return f
+
+    def copyfile(self, source, outputfile):
+        started, sent = time.perf_counter(), 0
+        while self._remaining > 0:
+            data = source.read(min(self.chunk, self._remaining))
+            if not data:
+                break
+            try:
+                outputfile.write(data)
+            except (BrokenPipeError, ConnectionResetError):
+                # the player dropped the connection to seek elsewhere
+                break
+            self._remaining -= len(data)
+            sent += len(data)
+            if self.bandwidth:
+                ahead = sent / self.bandwidth - (time.perf_counter() - started)
+                if ahead > 0:
+                    time.sleep(ahead)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_fixtures(directory, bandwidth):
+    # local http server over the fixtures, returns (server, base url)
+    handler = type("Handler", (RangeRequestHandler,), {"bandwidth": bandwidth})
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0),
+        lambda *a, **kw: handler(*a, directory = directory, **kw))
+    server.daemon_threads = True
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+    return server, "http://127.0.0.1:%d/" % server.server_address[1]
+
+
+def check_thumbnails(uri, seconds, width, height):
+    # sprite sheet of a videotestsrc fixture: tile count and size follow the clip, and
+    # the moving ball makes every tile different from the one before
+    extractor = ThumbnailExtractor()
+    started = time.perf_counter()
+    sprite = SpriteSheet(extractor.extract(uri))
+    elapsed = time.perf_counter() - started
+    expected = int(min(extractor.max_tiles, max(1, seconds * Gst.SECOND // extractor.min_interval)))
+    tiles = [sprite.tile_bytes(i) for i in range(sprite.count)]
+    problems = []
+    if sprite.count != expected:
+        problems.append("%d tiles, expected %d" % (sprite.count, expected))
+    if (sprite.width, sprite.height) != (extractor.tile_width, extractor.tile_width * height // width):
+        problems.append("tile size %dx%d" % (sprite.width, sprite.height))
+    if any(len(set(tile)) < 2 for tile in tiles):
+        problems.append("blank tile")
+    if any(a == b for a, b in zip(tiles, tiles[1:])):
+        problems.append("repeated tile")
+    sprite.close()
+    return {"ok": not problems, "problems": problems, "tiles": len(tiles), "seconds": elapsed}
+
+
+def bench_frame_tap(uri, seconds, format, work_ms):
+    # plays uri for seconds with a FrameTap plugin that touches every pixel (plus
+    # work_ms of simulated analysis) and reports the frames it got per second
+    tap = FrameTap(format)
+    latencies = []
+
+    def plugin(frame, timestamp):
+        started = time.perf_counter()
+        frame.mean()
+        if work_ms:
+            time.sleep(work_ms / 1000)
+        latencies.append(time.perf_counter() - started)
+
+    tap.add_plugin(plugin)
+    player = VideoPlayer(None, None, None, [uri], video_sink = "fakesink", audio_sink = "fakesink",
+                         frame_tap = tap)
+    player.start()
+    wait_for(lambda: player.first_frame_latency is not None)
+    started = time.perf_counter()
+    wait_for(lambda: time.perf_counter() - started >= seconds, seconds + 5)
+    elapsed = time.perf_counter() - started
+    player.close()
+    return {
+        "format": format,
+        "work_ms": work_ms,
+        "delivered": tap.delivered,
+        "dropped": tap.dropped,
+        "converted": tap.converted,
+        "frames_per_s": tap.delivered / elapsed,
+        "plugin": summary(latencies),
+    }
+
+
+def bench_chapters(uri, seconds):
+    # scene detection has to run far ahead of real time to be useful while watching
+    started = time.perf_counter()
+    chapters = SceneDetector().detect(uri)
+    elapsed = time.perf_counter() - started
+    return {"cuts": len(chapters) - 1, "seconds": elapsed, "realtime_factor": seconds / elapsed}
+
+
+def bench_waveform(uri, seconds):
+    started = time.perf_counter()
+    waveform = WaveformService().compute(uri)
+    elapsed = time.perf_counter() - started
+    return {"buckets": len(waveform.peak), "peak": float(waveform.peak.max()),
+            "seconds": elapsed, "realtime_factor": seconds / elapsed}
+
+
+def run(uris, args):
+    startup, switches, seeks, cpu, rss, stalls, steps = [], [], [], [], [], [], []
+    cache = {"hits": 0, "misses": 0}
+    after_pause = {"hits": 0, "misses": 0}
+    for iteration in range(args.iterations):
+        wall0, cpu0 = time.perf_counter(), cpu_seconds()
+
+        player = VideoPlayer(None, None, None, uris, preload = args.preload,
+                             video_sink = "fakesink", audio_sink = "fakesink",
+                             ring_buffer_size = args.ring_buffer * 1024 * 1024,
+                             frame_cache = FrameCache(args.frame_cache) if args.frame_cache else None)
+        player.start()
+        wait_for(lambda: player.first_frame_latency is not None)
+        startup.append(player.first_frame_latency)
+
+        direction = 1
+        for _ in range(args.switches):
+            if not 0 <= player.index + direction < len(uris):
+                direction = -direction
+            count = len(player.switch_latencies)
+            if direction > 0:
+                player.nextVideo()
+            else:
+                player.previousVideo()
+            wait_for(lambda: len(player.switch_latencies) > count)
+        switches.extend(player.switch_latencies)
+
+        for i in range(args.seeks):
+            count = len(player.scrubber.latencies)
+            player.skip_time(1 if i % 2 == 0 else -1)
+            wait_for(lambda: len(player.scrubber.latencies) > count)
+        seeks.extend(player.scrubber.latencies)
+
+        if args.steps and player.frame_cache is not None:
+            # steps back right after a pause come from the frames kept while playing,
+            # then forward steps decode and fill the cache and the steps back reuse them
+            wait_for(lambda: player.current_position() >= Gst.SECOND)
+            player.pause()
+            wait_for(lambda: player.player.get_state(0)[1] == Gst.State.PAUSED)
+            for i, direction in enumerate((-1, 1, -1)):
+                for _ in range(args.steps):
+                    started = time.perf_counter()
+                    count = len(player.scrubber.latencies)
+                    position = player.current_position()
+                    player.step_frame(direction)
+                    wait_for(lambda: player.current_position() != position or
+                             len(player.scrubber.latencies) > count)
+                    steps.append(time.perf_counter() - started)
+                if i == 0:
+                    for key in after_pause:
+                        after_pause[key] += player.frame_cache.counters()[key]
+            for key in cache:
+                cache[key] += player.frame_cache.counters()[key]
+
+        stalls.extend(counters["stall_s"] for counters in player.stats.files.values())
+        player.close()
+        cpu.append((cpu_seconds() - cpu0) / (time.perf_counter() - wall0))
+        rss.append(rss_bytes())
+
+    return {
+        "gstreamer": Gst.version_string(),
+        "import_s": import_time,
+        "iterations": args.iterations,
+        "preload": args.preload,
+        "launch_to_first_frame": summary(startup),
+        "switch": summary(switches),
+        "seek": summary(seeks),
+        "buffering_stall": summary(stalls),
+        "frame_step": summary(steps),
+        "frame_cache": dict(cache, hit_rate = cache["hits"] / max(1, cache["hits"] + cache["misses"])),
+        "frame_cache_back_after_pause": dict(after_pause,
+            hit_rate = after_pause["hits"] / max(1, after_pause["hits"] + after_pause["misses"])),
+        "cpu_fraction_mean": statistics.mean(cpu),
+        "rss_bytes": {"first": rss[0], "last": rss[-1], "max": max(rss)},
+    }
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Headless pyVideoPlayer benchmark")
+    parser.add_argument("--iterations", type=int, default=5)
+    parser.add_argument("--switches", type=int, default=10, help="nextVideo/previousVideo calls per iteration")
+    parser.add_argument("--seeks", type=int, default=10, help="skip_time calls per iteration")
+    parser.add_argument("--preload", type=int, default=1)
+    parser.add_argument("--clips", type=int, default=3)
+    parser.add_argument("--steps", type=int, default=10, help="frame steps back after a pause, forward and back again per iteration")
+    parser.add_argument("--frame-cache", type=int, default=64, metavar="MB", help="player frame cache (0 disables)")
+    parser.add_argument("--seconds", type=int, default=30, help="length of each test clip")
+    parser.add_argument("--size", default="640x360", help="test clip WIDTHxHEIGHT")
+    parser.add_argument("--fixtures", help="directory to keep test clips in (default: a temporary one)")
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    parser.add_argument("--check-thumbnails", action="store_true",
+                        help="also build a sprite sheet from a fixture and verify it, exit 1 on failure")
+    parser.add_argument("--frame-tap", action="store_true",
+                        help="also measure frames/s delivered to a FrameTap plugin from a 1080p clip (needs numpy)")
+    parser.add_argument("--tap-format", default="GRAY8", help="frame format for --frame-tap")
+    parser.add_argument("--tap-work", type=float, default=0, metavar="MS",
+                        help="simulated analysis time per frame for --frame-tap")
+    parser.add_argument("--chapters", action="store_true",
+                        help="also time scene detection on a fixture (needs numpy)")
+    parser.add_argument("--waveform", action="store_true",
+                        help="also time the audio overview of a fixture (needs numpy)")
+    parser.add_argument("--http", action="store_true",
+                        help="play the clips from a local http server with range requests")
+    parser.add_argument("--bandwidth", type=int, default=2000, metavar="KB/S",
+                        help="throttle the --http server (0 = unthrottled)")
+    parser.add_argument("--ring-buffer", type=int, default=0, metavar="MB",
+                        help="player ring buffer for --http (0 keeps whole downloads)")
+    args = parser.parse_args()
+    if args.switches and args.clips < 2:
+        # next/previous on a single clip restarts it without a switch to time
+        parser.error("--switches needs --clips 2 or more (or --switches 0)")
+
+    width, height = (int(n) for n in args.size.split("x"))
+    with tempfile.TemporaryDirectory() as tmp:
+        fixtures = args.fixtures or tmp
+        os.makedirs(fixtures, exist_ok = True)
+        local = uris = make_fixtures(fixtures, args.clips, args.seconds, width, height)
+        server = None
+        if args.http:
+            server, base = serve_fixtures(fixtures, args.bandwidth * 1024)
+            uris = [base + uri.rsplit("/", 1)[1] for uri in uris]
+        report = run(uris, args)
+        if server is not None:
+            server.shutdown()
+            report["http"] = {"bandwidth_kbps": args.bandwidth, "ring_buffer_mb": args.ring_buffer}
+        if args.frame_tap:
+            path = os.path.join(fixtures, "bench1080p.mkv")
+            if not os.path.exists(path):
+                make_test_clip(path, args.seconds, 1920, 1080)
+            report["frame_tap"] = bench_frame_tap(Gst.filename_to_uri(path), min(10, args.seconds),
+                                                  args.tap_format, args.tap_work)
+        # a fresh cache, so sprite sheets and chapters are really extracted
+        os.environ["XDG_CACHE_HOME"] = os.path.join(tmp, "cache")
+        if args.chapters:
+            report["chapters"] = bench_chapters(local[0], args.seconds)
+        if args.waveform:
+            report["waveform"] = bench_waveform(local[0], args.seconds)
+        if args.check_thumbnails:
+            report["thumbnails"] = check_thumbnails(local[0], args.seconds, width, height)
+
+    text = json.dumps(report, indent = 2)
+    if args.output:
+        with open(args.output, "w") as out:
+            out.write(text + "\n")
+    else:
+        print(text)
+    if "thumbnails" in report and not report["thumbnails"]["ok"]:
+        sys.exit(1)
@@ -0,0 +1,201 @@
+#!/usr/bin/python3
+#
+# Copyright 2019 Stan S
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Headless batch tool: writes a contact sheet (a grid of evenly spaced frames) and a
+# poster frame for every video under the given directories. Files are spread over a
+# pool of processes, each grabbing frames through its own pipeline.
+
+import os
+import sys
+import json
+import time
+import argparse
+import multiprocessing
+
+from pyVideoPlayer import Gst, GLib, GdkPixbuf, GenericException, FrameGrabber, ThumbnailExtractor, cache_dir
+from pyVideoPlayer import has_extension
+
+
+def find_videos(paths, ext):
+    # the files given plus everything under the directories given that the player's
+    # playlist would list
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    if has_extension(name, ext):
+                        yield os.path.abspath(os.path.join(root, name))
+        else:
+            yield os.path.abspath(path)
+
+
+def outputs(path, output):
+    # (contact sheet, poster) paths, next to the video unless an output directory is set
+    directory = os.path.dirname(path)
+    if output:
+        directory = os.path.join(output, os.path.relpath(directory, "/"))
+    base = os.path.join(directory, os.path.basename(path))
+    return base + ".sheet.jpg", base + ".poster.jpg"
+
+
+def up_to_date(path, output):
+    mtime = os.stat(path).st_mtime_ns
+    return all(os.path.exists(out) and os.stat(out).st_mtime_ns >= mtime for out in outputs(path, output))
+
+
+def pixbuf(sample):
+    structure = sample.get_caps().get_structure(0)
+    width, height = structure.get_value("width"), structure.get_value("height")
+    data = ThumbnailExtractor._packed(sample, width, height)
+    return GdkPixbuf.Pixbuf.new_from_bytes(GLib.Bytes.new(data),
+        GdkPixbuf.Colorspace.RGB, False, 8, width, height, width * 3)
+
+
+def make_sheet(job):
+    # worker process: (path, options) -> (path, frames, seconds, error)
+    path, options = job
+    started = time.perf_counter()
+    grabber = None
+    frames = 0
+    try:
+        # inside the try: a pipeline that can't be built fails this file, not the batch
+        grabber = FrameGrabber(Gst.filename_to_uri(path), options["poster_width"])
+        duration = grabber.open()
+        if not duration:
+            raise GenericException("unknown duration")
+        count = options["columns"] * options["rows"]
+        tiles = []
+        for i in range(count):
+            sample = grabber.grab(duration * (2 * i + 1) // (2 * count))
+            if sample is None:
+                raise GenericException("no frame at tile %d" % i)
+            tiles.append(pixbuf(sample))
+            frames += 1
+        poster = grabber.grab(duration * options["poster_at"] // 100, accurate = True)
+        if poster is None:
+            raise GenericException("no poster frame")
+        frames += 1
+
+        width = options["tile_width"]
+        height = width * tiles[0].get_height() // tiles[0].get_width()
+        spacing = 2
+        sheet = GdkPixbuf.Pixbuf.new(GdkPixbuf.Colorspace.RGB, False, 8,
+                                     options["columns"] * (width + spacing) + spacing,
+                                     options["rows"] * (height + spacing) + spacing)
+        sheet.fill(0x000000ff)
+        for i, tile in enumerate(tiles):
+            x = spacing + i % options["columns"] * (width + spacing)
+            y = spacing + i // options["columns"] * (height + spacing)
+            tile.scale_simple(width, height, GdkPixbuf.InterpType.BILINEAR).copy_area(0, 0, width, height, sheet, x, y)
+
+        sheet_path, poster_path = outputs(path, options["output"])
+        os.makedirs(os.path.dirname(sheet_path), exist_ok = True)
+        quality = str(options["quality"])
+        # written under a temporary name so an interrupted run never leaves a file that looks done
+        for image, out in ((sheet, sheet_path), (pixbuf(poster), poster_path)):
+            image.savev(out + ".tmp", "jpeg", ["quality"], [quality])
+            os.replace(out + ".tmp", out)
+        return path, frames, time.perf_counter() - started, None
+    except Exception as e:
+        return path, frames, time.perf_counter() - started, str(e)
+    finally:
+        if grabber is not None:
+            grabber.close()
+
+
+class Progress:
+    # JSON lines of finished files, so an interrupted run picks up where it stopped and
+    # doesn't try failing files again until they change (or --retry-failed is given)
+
+    def __init__(self, path):
+        self.path = path
+        self.done = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # torn last line of an interrupted run
+                    self.done[entry["path"]] = entry
+        self._file = open(path, "a")
+
+    def failed(self, path):
+        entry = self.done.get(path)
+        return entry is not None and entry["error"] is not None and entry["mtime"] == os.stat(path).st_mtime_ns
+
+    def record(self, path, error):
+        entry = {"path": path, "mtime": os.stat(path).st_mtime_ns, "error": error}
+        self.done[path] = entry
+        self._file.write(json.dumps(entry) + "\n")
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Contact sheets and poster frames for whole directories")
+    parser.add_argument("paths", nargs="+", metavar="path", help="video files or directories to walk")
+    parser.add_argument("--ext", default=".mp4,.mkv", help="comma separated extensions to include")
+    parser.add_argument("--output", help="directory to write into (default: next to each video)")
+    parser.add_argument("--columns", type=int, default=4)
+    parser.add_argument("--rows", type=int, default=4)
+    parser.add_argument("--tile-width", type=int, default=240)
+    parser.add_argument("--poster-width", type=int, default=640)
+    parser.add_argument("--poster-at", type=int, default=10, metavar="PERCENT",
+                        help="where in the video the poster frame is taken")
+    parser.add_argument("--quality", type=int, default=85, help="JPEG quality")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--progress", default=os.path.join(cache_dir(), "sheets-progress.jsonl"),
+                        help="file recording finished files, to resume an interrupted run")
+    parser.add_argument("--retry-failed", action="store_true", help="try files that failed before again")
+    parser.add_argument("--force", action="store_true", help="redo files whose outputs are up to date")
+    args = parser.parse_args()
+
+    progress = Progress(args.progress)
+    options = {key: getattr(args, key) for key in
+               ("output", "columns", "rows", "tile_width", "poster_width", "poster_at", "quality")}
+    todo, skipped = [], 0
+    for path in find_videos(args.paths, args.ext.split(",")):
+        if not args.force and (up_to_date(path, args.output) or
+                               (not args.retry_failed and progress.failed(path))):
+            skipped += 1
+        else:
+            todo.append((path, options))
+    print("%d to do, %d up to date or failed before" % (len(todo), skipped))
+
+    started = time.perf_counter()
+    frames = failed = 0
+    # spawn: the workers start a fresh GStreamer instead of inheriting ours across fork()
+    with multiprocessing.get_context("spawn").Pool(max(1, args.workers)) as pool:
+        for i, (path, count, seconds, error) in enumerate(pool.imap_unordered(make_sheet, todo), 1):
+            frames += count
+            progress.record(path, error)
+            if error is not None:
+                failed += 1
+                print("[%d/%d] %s failed: %s" % (i, len(todo), path, error))
+            else:
+                print("[%d/%d] %s (%d frames, %.1f s)" % (i, len(todo), path, count, seconds))
+    progress.close()
+
+    elapsed = time.perf_counter() - started
+    if todo:
+        print("%d files in %.1f s: %.1f files/min, %.1f frames/s, %d failed" % (
+            len(todo), elapsed, len(todo) * 60 / elapsed, frames / elapsed, failed))
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,220 @@
+#!/usr/bin/python3
+#
+# Copyright 2019 Stan S
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Soak test for pyVideoPlayer: drives a headless VideoPlayer through thousands of
+# next/previous/skip/pause cycles over generated clips and samples RSS, live objects,
+# open file descriptors and GLib sources. Exits 1 if any of them keeps growing past
+# its threshold after the warm-up.
+
+import os
+import gc
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+
+# the leaks tracer counts live GstObjects and has to be set up before Gst.init()
+os.environ.setdefault("GST_TRACERS", "leaks")
+
+from pyVideoPlayer import Gst, GLib, GObject, VideoPlayer, GenericException
+from pyVideobench import wait_for, rss_bytes, make_fixtures
+
+
+def gobjects():
+    # GObjects that still have a Python wrapper
+    return sum(1 for o in gc.get_objects() if isinstance(o, GObject.Object))
+
+
+def gst_objects():
+    # live GstObjects/GstMiniObjects according to the leaks tracer, None without it
+    try:
+        tracers = Gst.tracing_get_active_tracers()
+    except AttributeError:
+        return None
+    for tracer in tracers:
+        if tracer.__gtype__.name == "GstLeaksTracer":
+            try:
+                return len(tracer.emit("get-live-objects").get_value("live-objects-list"))
+            except (TypeError, AttributeError):
+                return None
+    return None
+
+
+def open_fds():
+    try:
+        return len(os.listdir("/proc/self/fd"))
+    except OSError:
+        return None
+
+
+def glib_sources():
+    # attached sources of the default context: ids only go up, so probe every id up to
+    # the one a throw-away source gets now
+    context = GLib.MainContext.default()
+    newest = GLib.idle_add(lambda: False)
+    GLib.source_remove(newest)
+    return sum(1 for i in range(1, newest) if context.find_source_by_id(i) is not None)
+
+
+def sample(cycle, started):
+    gc.collect()
+    return {
+        "cycle": cycle,
+        "seconds": time.perf_counter() - started,
+        "rss_bytes": rss_bytes(),
+        "gobjects": gobjects(),
+        "gst_objects": gst_objects(),
+        "fds": open_fds(),
+        "glib_sources": glib_sources(),
+    }
+
+
+def soak(player, cycles, every, seed, samples, timeouts, max_timeouts = 10):
+    # fills samples and timeouts as it goes, so they survive an exception; an action
+    # that never completes is recorded and the run goes on, until max_timeouts of them
+    # suggest the player is wedged
+    rng = random.Random(seed)
+    started = time.perf_counter()
+    samples.append(sample(0, started))
+
+    def switch(direction):
+        # turn around at the ends like pyVideobench.run: there next/previous restart
+        # the same file, which records no switch latency
+        if not 0 <= player.index + direction < len(player.files):
+            direction = -direction
+        count = len(player.switch_latencies)
+        if direction > 0:
+            player.nextVideo()
+        else:
+            player.previousVideo()
+        wait_for(lambda: len(player.switch_latencies) > count)
+
+    def skip(direction):
+        count = len(player.scrubber.latencies)
+        player.skip_time(direction)
+        wait_for(lambda: len(player.scrubber.latencies) > count)
+
+    actions = [
+        ("next", lambda: switch(1)),
+        ("previous", lambda: switch(-1)),
+        ("forward", lambda: skip(1)),
+        ("backward", lambda: skip(-1)),
+        ("playpause", player.toggle_playpause),
+    ]
+    paused_at = None
+    for cycle in range(1, cycles + 1):
+        # a pause holds through the next action, so it is soaked too, then playback resumes
+        if player.is_playing:
+            paused_at = None
+        elif paused_at is None:
+            paused_at = cycle - 1
+        elif cycle - paused_at >= 2:
+            player.play()
+            paused_at = None
+        name, action = rng.choice(actions)
+        try:
+            action()
+        except GenericException as e:
+            timeouts.append({"cycle": cycle, "action": name, "error": str(e)})
+            print("cycle %d: %s timed out" % (cycle, name), file = sys.stderr)
+            if len(timeouts) >= max_timeouts:
+                samples.append(sample(cycle, started))
+                break
+        if cycle % every == 0:
+            samples.append(sample(cycle, started))
+            print(json.dumps(samples[-1]), file = sys.stderr)
+
+
+def check(samples, warmup, limits):
+    # growth from the first sample after the warm-up to the last
+    baseline = next((s for s in samples if s["cycle"] >= warmup), samples[0])
+    last = samples[-1]
+    failures = []
+    for key, limit in limits.items():
+        if baseline[key] is None or last[key] is None:
+            continue
+        growth = last[key] - baseline[key]
+        if growth > limit:
+            failures.append("%s grew by %d (limit %d)" % (key, growth, limit))
+    return failures
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Headless pyVideoPlayer soak test")
+    parser.add_argument("--cycles", type=int, default=2000, help="next/previous/skip/pause actions")
+    parser.add_argument("--every", type=int, default=100, help="cycles between samples")
+    parser.add_argument("--warmup", type=int, default=200, help="cycles before the baseline sample")
+    parser.add_argument("--preload", type=int, default=1)
+    parser.add_argument("--clips", type=int, default=4)
+    parser.add_argument("--seconds", type=int, default=60, help="length of each test clip")
+    parser.add_argument("--size", default="320x180", help="test clip WIDTHxHEIGHT")
+    parser.add_argument("--fixtures", help="directory to keep test clips in (default: a temporary one)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--max-rss-growth", type=int, default=50, metavar="MB")
+    parser.add_argument("--max-gobject-growth", type=int, default=200)
+    parser.add_argument("--max-gst-object-growth", type=int, default=500,
+                        help="live GstObjects and GstMiniObjects counted by the leaks tracer")
+    parser.add_argument("--max-fd-growth", type=int, default=10)
+    parser.add_argument("--max-source-growth", type=int, default=5)
+    parser.add_argument("--max-timeouts", type=int, default=10,
+                        help="actions allowed to time out before the run stops")
+    parser.add_argument("--output", help="write the samples and verdict as JSON here instead of stdout")
+    args = parser.parse_args()
+    if args.clips < 2:
+        parser.error("--clips must be at least 2 to switch between them")
+
+    width, height = (int(n) for n in args.size.split("x"))
+    samples, timeouts, aborted = [], [], None
+    with tempfile.TemporaryDirectory() as tmp:
+        fixtures = args.fixtures or tmp
+        os.makedirs(fixtures, exist_ok = True)
+        uris = make_fixtures(fixtures, args.clips, args.seconds, width, height)
+        player = VideoPlayer(None, None, None, uris, preload = args.preload,
+                             video_sink = "fakesink", audio_sink = "fakesink")
+        try:
+            player.start()
+            wait_for(lambda: player.first_frame_latency is not None)
+            soak(player, args.cycles, args.every, args.seed, samples, timeouts, args.max_timeouts)
+        except Exception as e:
+            # still write out whatever was sampled, with the reason
+            aborted = "%s: %s" % (type(e).__name__, e)
+        finally:
+            player.close()
+
+    failures = ["aborted: " + aborted] if aborted else []
+    if timeouts:
+        failures.append("%d actions timed out" % len(timeouts))
+    if samples:
+        failures += check(samples, args.warmup, {
+            "rss_bytes": args.max_rss_growth * 1024 * 1024,
+            "gobjects": args.max_gobject_growth,
+            "gst_objects": args.max_gst_object_growth,
+            "fds": args.max_fd_growth,
+            "glib_sources": args.max_source_growth,
+        })
+    text = json.dumps({"ok": not failures, "failures": failures, "timeouts": timeouts,
+                       "samples": samples}, indent = 2)
+    if args.output:
+        with open(args.output, "w") as out:
+            out.write(text + "\n")
+    else:
+        print(text)
+    for failure in failures:
+        print("FAIL: " + failure, file = sys.stderr)
+    sys.exit(1 if failures else 0)
@@ -3,7 +3,9 @@
 import os
 import sys
 import time
+import bisect
 import ctypes
+import threading
 
 import gi
 gi.require_version("Gtk", "3.0")
@@ -32,6 +34,52 @@ else:
     def get_window_handle(widget):
         return widget.get_window().get_xid()
 
+class Playlist:
+    # The videos of one directory, in reverse name order. Only the launched file is
+    # listed until load_async() has scanned the directory with os.scandir on a thread,
+    # so playback starts right away. Names are kept sorted for bisect lookups.
+
+    ext = (".mp4", ".mkv")
+
+    def __init__(self, path):
+        path = os.path.abspath(path)
+        self.directory = os.path.dirname(path)
+        self.current = os.path.basename(path)
+        # called from the main loop once the directory is listed
+        self.on_change = None
+        self._names = [self.current]
+
+    def __len__(self):
+        return len(self._names)
+
+    def __getitem__(self, index):
+        name = self._names[len(self._names) - 1 - index]
+        return Gst.filename_to_uri(os.path.join(self.directory, name))
+
+    def index_of(self, item):
+        # item is a uri or path; None when it isn't listed
+        if "://" in item:
+            item = GLib.filename_from_uri(item)[0]
+        name = os.path.basename(item)
+        i = bisect.bisect_left(self._names, name)
+        if i < len(self._names) and self._names[i] == name:
+            return len(self._names) - 1 - i
+        return None
+
+    def load_async(self):
+        def scan():
+            with os.scandir(self.directory) as it:
+                names = sorted(entry.name for entry in it
+                               if entry.name.lower().endswith(self.ext) or entry.name == self.current)
+            GLib.idle_add(self._loaded, names)
+        threading.Thread(target = scan, daemon = True).start()
+
+    def _loaded(self, names):
+        self._names = names
+        if self.on_change is not None:
+            self.on_change()
+        return False
+
 class VideoPlayer:
 
     is_fullscreen = False
@@ -43,6 +91,14 @@ class VideoPlayer:
         self._setupplayer()
         self.index = index
         self.files = filelist 
+        self.files.on_change = self._on_playlist_changed
+    
+    def _on_playlist_changed(self):
+        # keep pointing at the playing file when the directory listing lands
+        uri = self.player.get_property("uri")
+        index = self.files.index_of(uri) if uri else None
+        if index is not None:
+            self.index = index
     
     def _setupplayer(self):
         self._video_overlay = None
@@ -124,21 +180,9 @@ if __name__ == "__main__":
 
     if len(sys.argv) > 1:
 
-        ext = (".mp4",".mkv")
-        videos = []
         directory = os.path.dirname(   os.path.abspath(sys.argv[1])   )
         print ('directory' + directory )
-        print ( 'file:///' + os.path.abspath(os.path.join(directory, sys.argv[1])) )
-        videos.append ( 'file:///' + os.path.abspath(os.path.join(directory, sys.argv[1])) )
-        
-        files = sorted(os.listdir(directory), reverse = True)
-        for file in files:
-            if file.lower().endswith(ext):
-                videos.append('file:///' + os.path.abspath(os.path.join(directory, file)))
-            
-        print ( 'length of videos:' + str(len(videos)) )
-        for v in videos:
-            print (v)
+        videos = Playlist(sys.argv[1])
         
         window = Gtk.Window()
 
@@ -152,7 +196,8 @@ if __name__ == "__main__":
         canvas1.set_size_request(400, 400)
         canvas_box.add(canvas1)
 
-        player = VideoPlayer(window, canvas1, videos)
+        player = VideoPlayer(window, canvas1, videos, videos.index_of(sys.argv[1]))
+        videos.load_async()
 
         window.connect("key-press-event", player.on_key_press)
 